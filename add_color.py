@@ -1,93 +1,132 @@
 
+import functools
 import os
+import re
 import sys
+import time
 import numpy as np
-import subprocess
-import glob
 
 from osgeo import gdal
 
+import manifest
+import scene_pool
 
-def add_color_table(vrt, clr):
+# The brightness, greenness, and wetness color tables are found next to this script
+TABLE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_outfile(outdir, infile, tc_band):
+    """
+    Return the path set_color writes the colored band to
+    :param outdir: <str>
+    :param infile: <str>
+    :param tc_band: <str>
+    :return: <str>
     """
+    base_name = os.path.splitext(os.path.basename(infile))[0]
 
-    :param vrt:
-    :param clr:
-    :return:
+    return f"{outdir}{os.sep}color{os.sep}{tc_band}{os.sep}{base_name}.tif"
+
+
+def get_table_path(tc_band):
     """
-    with open(clr, "r") as color_table:
-        dirname, filename = os.path.split(vrt)
-        filebase, fileext = os.path.splitext(filename)
+    Return the color table of a TC band, stored alongside this script
+    :param tc_band: <str>
+    :return: <str>
+    """
+    return f"{TABLE_DIR}{os.sep}{tc_band}.txt"
 
-        out_vrt = f"{dirname}{os.sep}zzzz{filebase}.vrt"
 
-        with open(vrt, "r+") as txt:
-            txt_read = txt.readlines()
+def read_entries(clr):
+    """
+    Read the entries of a color table, either the GDAL XML <Entry c1= c2= c3= c4=/> lines of the .txt
+    tables or the "index red green blue" lines of an ArcMap .clr table
+    :param clr: <str>
+    :return: <list> (index, (red, green, blue, alpha))
+    """
+    entries = []
 
-            key = '<VRTRasterBand dataType="Byte" band="1">'
+    with open(clr, "r") as color_table:
+        for line in color_table:
+            line = line.strip()
 
-            with open(out_vrt, "wb") as out_txt:
-                for line in txt_read:
-                    write_line = r"%s" % line
+            if line.startswith("<Entry"):
+                values = [int(value) for value in re.findall(r'c\d="(\d+)"', line)]
 
-                    out_txt.write(write_line.encode("utf-8"))
+                entries.append((len(entries), tuple(values + [255] * (4 - len(values)))))
 
-                    if key in line:
-                        color_read = color_table.readlines()
+            elif len(line) > 0 and line[0].isdigit():
+                values = [int(value) for value in line.split()]
 
-                        for ln in color_read:
-                            out_txt.write(ln.encode("utf-8"))
+                entries.append((values[0], tuple(values[1:4] + [255])))
 
-    return out_vrt
+    return entries
 
 
-def set_color(outdir, infile, tc_band):
+@functools.lru_cache(maxsize=None)
+def get_color_table(clr):
     """
-
-    :param outdir:
-    :param infile:
-    :param tc_band:
-    :return:
+    Parse a color table once per process
+    :param clr: <str>
+    :return: <gdal.ColorTable>
     """
-    base_dir = outdir
-    color_dir = outdir + os.sep + "color" + os.sep + tc_band
-    base_name = os.path.splitext(os.path.basename(infile))[0]
+    color_table = gdal.ColorTable()
 
-    if not os.path.exists(color_dir):
-        os.makedirs(color_dir)
+    for index, color in read_entries(clr):
+        color_table.SetColorEntry(index, color)
 
-    clrtable = f"{tc_band}.txt"
+    return color_table
 
-    temp_csvfile = f"{base_dir}{os.sep}zzzz_{base_name}.csv"
 
-    outfile = f"{color_dir}{os.sep}{base_name}.tif"
+def set_color(outdir, infile, tc_band, clr=None):
+    """
+    Write band 1 of infile with the TC band's color table in a single copy.  A VRT of the band is built in
+    memory and given the color table, so the georeferencing, nodata, and metadata are kept as they were.
+    :param outdir: <str>
+    :param infile: <str>
+    :param tc_band: <str>
+    :param clr: <str> The color table, by default the TC band's table from get_table_path
+    :return:
+    """
+    outfile = get_outfile(outdir, infile, tc_band)
 
-    tempoutfile = f"{base_dir}{os.sep}zzzz_{base_name}.tif"
+    color_dir = os.path.dirname(outfile)
 
-    translate_to_copy = f"gdal_translate -of GTiff -b 1 -q {infile} {tempoutfile}"
+    if not os.path.exists(color_dir):
+        os.makedirs(color_dir)
 
-    subprocess.call(translate_to_copy, shell=True)
+    vrt = gdal.Translate("", infile, format="VRT", bandList=[1])
 
-    with open(temp_csvfile, "wb") as open_csv:
-        open_csv.write(tempoutfile.encode("utf-8") + "\r\n".encode("utf-8"))
+    if vrt is None:
+        print(f"Could not open file {infile}")
+        sys.exit(1)
 
-    temp_vrt = f"{base_dir}{os.sep}zzzz_{base_name}.vrt"
+    band = vrt.GetRasterBand(1)
 
-    build_vrt = f"gdalbuildvrt -q -input_file_list {temp_csvfile} {temp_vrt}"
+    band.SetRasterColorTable(get_color_table(clr or get_table_path(tc_band)))
+    band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
 
-    subprocess.call(build_vrt, shell=True)
+    out_raster = gdal.GetDriverByName("GTiff").CreateCopy(outfile, vrt)
 
-    color_vrt = add_color_table(temp_vrt, clrtable)
+    if out_raster is None:
+        print(f"Could not create raster {outfile}")
+        sys.exit(1)
 
-    translate_to_color = f"gdal_translate -of GTiff -q {color_vrt} {outfile}"
+    out_raster, band, vrt = None, None, None
 
-    subprocess.call(translate_to_color, shell=True)
+    return None
 
-    # Remove temporary files
-    for f in glob.glob(f"{base_dir}{os.sep}zzz*"):
-        os.remove(f)
 
-    return None
+def color_file(item, outdir):
+    """
+    Call set_color for an (infile, tc_band) item given to scene_pool.run_scenes
+    :param item: <tuple>
+    :param outdir: <str>
+    :return:
+    """
+    print(f"Working on file {item[0]}\n")
+
+    return set_color(outdir=outdir, infile=item[0], tc_band=item[1])
 
 
 def get_data(infile):
@@ -121,11 +160,13 @@ def get_files(in_dir, lookfor):
     return file_list
 
 
-def main_work(root_dir, output_dir):
+def main_work(root_dir, output_dir, manifest_file=None, workers=1):
     """
 
     :param root_dir:
     :param output_dir:
+    :param manifest_file: <str> Optional run manifest, files it records as done are skipped
+    :param workers: <int> The number of files to color in parallel
     :return:
     """
     lookup_files = {}
@@ -139,11 +180,17 @@ def main_work(root_dir, output_dir):
     w_files = get_files(root_dir, lookfor="wetness")
     lookup_files["wetness"] = w_files
 
-    for key in lookup_files.keys():
-        for file in lookup_files[key]:
-            print(f"Working on file {file}\n")
+    tasks = ((file, [file, get_table_path(key)], [get_outfile(output_dir, file, key)], (file, key))
+             for key in lookup_files.keys() for file in lookup_files[key])
+
+    run_manifest = manifest.Manifest(manifest_file) if manifest_file is not None else None
 
-            set_color(outdir=output_dir, infile=file, tc_band=key)
+    start = time.time()
+
+    results = list(manifest.run_stage(run_manifest, "add_color", tasks, {}, color_file, args=(output_dir,),
+                                      workers=workers))
+
+    scene_pool.summarize(results, elapsed=time.time() - start)
 
 
 if __name__ == "__main__":
@@ -157,6 +204,13 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--output", dest="output_dir", type=str, required=True,
                         help="The full path to the output root directory")
 
+    parser.add_argument("--manifest", dest="manifest_file", type=str, required=False, default=None,
+                        help="The full path to a run manifest, created if it does not exist, files it records as "
+                             "done are skipped")
+
+    parser.add_argument("-n", "--workers", dest="workers", type=int, required=False, default=1,
+                        help="The number of files to color in parallel, default is 1")
+
     args = parser.parse_args()
 
     main_work(**vars(args))
\ No newline at end of file
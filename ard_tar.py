@@ -0,0 +1,110 @@
+"""
+Locate the band files inside ARD .tar archives so they can be read in place through GDAL's /vsitar/
+virtual file system, without unpacking or stacking the archives first
+"""
+
+import functools
+import os
+
+from osgeo import gdal
+
+VSITAR = "/vsitar/"
+
+
+def get_tar_path(scene):
+    """
+    Return the path to the .tar archive, removing any /vsitar/ prefix or member file name
+    :param scene: <str>
+    :return: <str>
+    """
+    if scene.startswith(VSITAR):
+        scene = scene[len(VSITAR):]
+
+    return scene[:scene.index(".tar") + 4]
+
+
+def get_entity_id(scene):
+    """
+    Return the 40 character id that begins the name of the scene's archive, members, and stack
+    :param scene: <str> Path to the archive, a member of it, or a stack of its bands
+    :return: <str>
+    """
+    return os.path.basename(scene)[:40]
+
+
+def get_date(scene):
+    """
+    Return the acquisition date of a scene as YYYYMMDD
+    :param scene: <str>
+    :return: <str>
+    """
+    return get_entity_id(scene)[15:23]
+
+
+def get_hv(scene):
+    """
+    Return the ARD tile of a scene
+    :param scene: <str>
+    :return: <tuple> (h, v)
+    """
+    entity_id = get_entity_id(scene)
+
+    return int(entity_id[8:11]), int(entity_id[11:14])
+
+
+@functools.lru_cache(maxsize=1024)
+def get_members(tar_path):
+    """
+    Index the .tif members of an archive by band name, e.g. "TAB1" or "PIXELQA".  The archive listing is
+    only read once per process.
+    :param tar_path: <str>
+    :return: <dict> Band name to /vsitar/ path
+    """
+    vsi_path = f"{VSITAR}{tar_path}"
+
+    names = gdal.ReadDir(vsi_path)
+
+    if names is None:
+        raise IOError(f"Could not read the archive {tar_path}")
+
+    members = {}
+
+    for name in names:
+        base, ext = os.path.splitext(name)
+
+        if ext == ".tif":
+            members[base.rsplit("_", 1)[-1]] = f"{vsi_path}/{name}"
+
+    return members
+
+
+def get_band_path(scene, band):
+    """
+    Return the /vsitar/ path to a band within the scene's archive
+    :param scene: <str> Path to the archive, with or without the /vsitar/ prefix
+    :param band: <str>
+    :return: <str>
+    """
+    members = get_members(get_tar_path(scene))
+
+    if band not in members:
+        raise IOError(f"Could not find band {band} in {scene}")
+
+    return members[band]
+
+
+def find_archives(directory, product="TA"):
+    """
+    Return the sorted paths to all ARD archives of the given product type under directory
+    :param directory: <str>
+    :param product: <str>
+    :return: <list>
+    """
+    tars = []
+
+    for root, folders, files in os.walk(directory):
+        for file in files:
+            if file.endswith(f"_{product}.tar"):
+                tars.append(os.path.join(root, file))
+
+    return sorted(tars)
@@ -0,0 +1,273 @@
+"""
+Micro-benchmarks comparing the original array routines against their optimized replacements using
+synthetic data, so they can be run without any ARD on hand.
+"""
+
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+import numpy as np
+
+import rescale
+import tasseled_cap
+import tc_numba
+
+
+def make_scene(size, sensor="L8", seed=0):
+    """
+    Generate synthetic float32 reflectance and PIXELQA bands in the dictionary layout tasseled_cap.calc
+    takes
+    :param size: <int> The number of rows and columns
+    :param sensor: <str>
+    :param seed: <int>
+    :return: <dict>
+    """
+    rng = np.random.RandomState(seed)
+
+    bands = {band[-2:]: rng.randint(0, 10000, size=(size, size)).astype(np.float32)
+             for band in tasseled_cap.get_band_list(sensor)[:-1]}
+
+    qa = np.full((size, size), 322, dtype=np.uint16)
+    qa[:, :size // 10] = 1
+
+    bands["QA"] = qa.astype(np.float32)
+
+    return bands
+
+
+def timeit(func, repeat=3):
+    """
+    Return the best wall clock time of several calls
+    :param func: <function>
+    :param repeat: <int>
+    :return: <float>
+    """
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def peak_memory(func):
+    """
+    Return the peak memory in MB allocated during a call, numpy allocations are traced by tracemalloc
+    :param func: <function>
+    :return: <float>
+    """
+    tracemalloc.start()
+
+    func()
+
+    peak = tracemalloc.get_traced_memory()[1]
+
+    tracemalloc.stop()
+
+    return peak / 1024 ** 2
+
+
+def bench_tc(size, sensor="L8"):
+    """
+    Three calls to tasseled_cap.calc versus one call to tasseled_cap.tc_transform
+    :param size: <int>
+    :param sensor: <str>
+    :return:
+    """
+    bands = make_scene(size, sensor)
+
+    coeffs = tasseled_cap.get_coeffs(sensor)
+
+    matrix = tasseled_cap.get_coeff_matrix(sensor)
+
+    refl = np.stack([bands[band[-2:]] for band in tasseled_cap.get_band_list(sensor)[:-1]])
+
+    qa = bands["QA"].astype(np.uint16)
+
+    out = np.empty((3, size, size), dtype=np.int16)
+    work = np.empty((3, size, size), dtype=np.float32)
+
+    old = timeit(lambda: [tasseled_cap.calc(coeffs[key], bands, sensor) for key in tasseled_cap.TC_BANDS])
+    new = timeit(lambda: tasseled_cap.tc_transform(refl, qa, matrix, out=out, work=work))
+
+    print(f"TC transform {size}x{size} {sensor}: calc x3 {old:.3f}s, tc_transform {new:.3f}s, "
+          f"speedup {old / new:.1f}x")
+
+    return None
+
+
+def bench_fixed(size, sensor="L8"):
+    """
+    tc_transform on float32 copies of the Int16 bands versus tc_transform_fixed on the Int16 bands, and the
+    largest difference between their outputs
+    :param size: <int>
+    :param sensor: <str>
+    :return:
+    """
+    bands = make_scene(size, sensor)
+
+    refl = np.stack([bands[band[-2:]] for band in tasseled_cap.get_band_list(sensor)[:-1]]).astype(np.int16)
+
+    qa = bands["QA"].astype(np.uint16)
+
+    matrix = tasseled_cap.get_coeff_matrix(sensor)
+
+    fixed_matrix = tasseled_cap.get_fixed_matrix(sensor)
+
+    def float_func():
+        return tasseled_cap.tc_transform(refl.astype(np.float32), qa, matrix)
+
+    def fixed_func():
+        return tasseled_cap.tc_transform_fixed(refl, qa, fixed_matrix)
+
+    old, new = timeit(float_func), timeit(fixed_func)
+
+    old_mb, new_mb = peak_memory(float_func), peak_memory(fixed_func)
+
+    diff = np.abs(float_func().astype(np.int32) - fixed_func()).max()
+
+    print(f"Fixed-point TC {size}x{size} {sensor}: float {old:.3f}s {old_mb:.0f} MB peak, "
+          f"fixed {new:.3f}s {new_mb:.0f} MB peak, max difference {diff} DN")
+
+    return None
+
+
+def get_calc_values(bands, sensor):
+    """
+    Return tasseled_cap.calc for each TC band before any conversion to integer.  calc truncates the
+    L4/L5/L7 results, so their bands are passed through the L8 branch, which has the same arithmetic.
+    :param bands: <dict> From make_scene
+    :param sensor: <str>
+    :return: <numpy.ndarray> (3, rows, columns)
+    """
+    keys = [band[-2:] for band in tasseled_cap.get_band_list(sensor)[:-1]]
+
+    l8_keys = [band[-2:] for band in tasseled_cap.get_band_list("L8")[:-1]]
+
+    l8_bands = {l8_key: bands[key] for key, l8_key in zip(keys, l8_keys)}
+
+    l8_bands["QA"] = bands["QA"]
+
+    coeffs = tasseled_cap.get_coeffs(sensor)
+
+    return np.stack([tasseled_cap.calc(coeffs[key], l8_bands, "L8") for key in tasseled_cap.TC_BANDS])
+
+
+def check_numba(size=500):
+    """
+    Check that the numba kernel gives exactly the rounded output of tasseled_cap.calc for every sensor
+    :param size: <int>
+    :return: <bool>
+    """
+    if not tc_numba.AVAILABLE:
+        print("numba is not installed, skipping the numba kernel check")
+        return True
+
+    passed = True
+
+    for sensor in ("L4", "L5", "L7", "L8"):
+        bands = make_scene(size, sensor)
+
+        refl = np.stack([bands[band[-2:]] for band in tasseled_cap.get_band_list(sensor)[:-1]]).astype(np.int16)
+
+        result = tc_numba.tc_transform_numba(refl, bands["QA"].astype(np.uint16),
+                                             tasseled_cap.get_coeff_matrix(sensor))
+
+        same = np.array_equal(np.rint(get_calc_values(bands, sensor)), result)
+
+        print(f"numba kernel {sensor}: {'identical to' if same else 'DIFFERENT from'} calc")
+
+        passed &= same
+
+    return passed
+
+
+def bench_numba(size, sensor="L8"):
+    """
+    tc_transform versus the fused numba kernel, after the numba kernel has been compiled
+    :param size: <int>
+    :param sensor: <str>
+    :return:
+    """
+    if not tc_numba.AVAILABLE:
+        print("numba is not installed, skipping the numba kernel benchmark")
+        return None
+
+    bands = make_scene(size, sensor)
+
+    refl = np.stack([bands[band[-2:]] for band in tasseled_cap.get_band_list(sensor)[:-1]])
+
+    refl_int = refl.astype(np.int16)
+
+    qa = bands["QA"].astype(np.uint16)
+
+    matrix = tasseled_cap.get_coeff_matrix(sensor)
+
+    out = np.empty((3, size, size), dtype=np.int16)
+    work = np.empty((3, size, size), dtype=np.float32)
+
+    tc_numba.tc_transform_numba(refl_int, qa, matrix, out=out)
+
+    old = timeit(lambda: tasseled_cap.tc_transform(refl, qa, matrix, out=out, work=work))
+    new = timeit(lambda: tc_numba.tc_transform_numba(refl_int, qa, matrix, out=out))
+
+    print(f"numba TC {size}x{size} {sensor}: tc_transform {old:.3f}s, numba {new:.3f}s, speedup {old / new:.1f}x")
+
+    return None
+
+
+def bench_rescale(size):
+    """
+    get_data's int32 upcast, clip_array and rescale_array versus rescale.clip_rescale on the native Int16
+    :param size: <int>
+    :return:
+    """
+    rng = np.random.RandomState(0)
+
+    array = rng.randint(-2000, 8000, size=(size, size)).astype(np.int16)
+
+    qa = rng.rand(size, size) > 0.1
+
+    limits = rescale.get_percentiles(array, qa)
+
+    def old_func():
+        clipped = rescale.clip_array(array.astype(np.int32), qa, [int(limits[0]), int(limits[1])])
+        return rescale.rescale_array(clipped, qa).astype(np.uint8)
+
+    def new_func():
+        return rescale.clip_rescale(array, qa, limits)
+
+    old, new = timeit(old_func), timeit(new_func)
+
+    old_mb, new_mb = peak_memory(old_func), peak_memory(new_func)
+
+    print(f"Clip and rescale {size}x{size}: old {old:.3f}s {old_mb:.0f} MB peak, "
+          f"clip_rescale {new:.3f}s {new_mb:.0f} MB peak")
+
+    return None
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run micro-benchmarks on synthetic data")
+
+    parser.add_argument("-s", "--size", dest="size", type=int, required=False, default=2000,
+                        help="The number of rows and columns of the synthetic scene, default is 2000")
+
+    args = parser.parse_args()
+
+    bench_tc(args.size)
+
+    bench_fixed(args.size)
+
+    passed = check_numba()
+
+    bench_numba(args.size)
+
+    bench_rescale(args.size)
+
+    if not passed:
+        sys.exit(1)
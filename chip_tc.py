@@ -0,0 +1,197 @@
+"""
+Calculate brightness, greenness, and wetness time series for individual 100 x 100 pixel chips of an ARD
+tile.  Only the chip windows are read from each archive, so a single chip costs 1/2500th of the reads of
+a whole scene.
+"""
+
+import os
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import ard_tar
+import scene_pool
+from geo_utils import CHIP_PIXELS, get_tile
+from tasseled_cap import TC_BANDS, get_band_list, get_coeff_matrix, get_sensor, open_bands, tc_transform
+
+# tc is (chips, time, 3, 100, 100) Int16 with the TC bands ordered as TC_BANDS, and fill pixels set to 0
+ChipSeries = namedtuple("ChipSeries", ["chip_ids", "dates", "sensors", "scenes", "tc"])
+
+
+def get_tile_scenes(ard_dir, h, v):
+    """
+    Return the archives under ard_dir that belong to tile h, v sorted by acquisition date
+    :param ard_dir: <str>
+    :param h: <int>
+    :param v: <int>
+    :return: <list>
+    """
+    scenes = [tar for tar in ard_tar.find_archives(ard_dir) if ard_tar.get_hv(tar) == (h, v)]
+
+    return sorted(scenes, key=ard_tar.get_date)
+
+
+def get_chip_windows(h, v, chip_ids):
+    """
+    Return the (column offset, row offset) of each chip within the tile
+    :param h: <int>
+    :param v: <int>
+    :param chip_ids: <list> Chip ids, 1 - 2500
+    :return: <list>
+    """
+    tile = get_tile(h, v)
+
+    windows = []
+
+    for chip_id in chip_ids:
+        extent = tile.CHIP_EXTENTS[chip_id]
+
+        rowcol = tile.geo_to_rowcol(tile.PIXEL_AFFINE, tile.GeoCoordinate(x=extent.x_min, y=extent.y_max))
+
+        windows.append((rowcol.column, rowcol.row))
+
+    return windows
+
+
+def read_chips(scene, windows):
+    """
+    Calculate the TC bands of the chip windows of a scene, reading only those windows from the archive
+    :param scene: <str>
+    :param windows: <list> (column offset, row offset) from get_chip_windows
+    :return: <numpy.ndarray> (chips, 3, 100, 100) Int16
+    """
+    sensor = get_sensor(scene=scene)
+
+    sources = open_bands(scene=scene, sensor=sensor)
+
+    shape = (len(windows), CHIP_PIXELS, CHIP_PIXELS)
+
+    refl = np.empty((6,) + shape, dtype=np.float32)
+    qa = np.empty(shape, dtype=np.uint16)
+
+    for ind, band in enumerate(get_band_list(sensor)):
+        src_band = sources[band[-2:]].GetRasterBand(1)
+
+        buffer = qa if band == "PIXELQA" else refl[ind]
+
+        for chip, (xoff, yoff) in enumerate(windows):
+            src_band.ReadAsArray(xoff, yoff, CHIP_PIXELS, CHIP_PIXELS, buf_obj=buffer[chip])
+
+    sources = None
+
+    # Move the chips to the front to give (chips, 3, 100, 100)
+    return np.moveaxis(tc_transform(refl=refl, qa=qa, matrix=get_coeff_matrix(sensor=sensor)), 0, 1)
+
+
+def get_chip_series(h, v, chip_ids, ard_dir=None, scenes=None, workers=1, cache_mb=None):
+    """
+    Return the TC time series of the chips across every scene of the tile, ordered by acquisition date.
+    Scenes that fail to read are reported and left out of the series.
+    :param h: <int>
+    :param v: <int>
+    :param chip_ids: <int or list> Chip ids, 1 - 2500
+    :param ard_dir: <str> Directory searched for the tile's ARD TA archives
+    :param scenes: <list> The archives to use instead of searching ard_dir
+    :param workers: <int> The number of scenes to read in parallel
+    :param cache_mb: <int> The GDAL cache size in megabytes for each worker
+    :return: <ChipSeries>
+    """
+    if isinstance(chip_ids, (int, np.integer)):
+        chip_ids = [chip_ids]
+
+    chip_ids = [int(chip_id) for chip_id in chip_ids]
+
+    if scenes is None:
+        scenes = get_tile_scenes(ard_dir, h, v)
+
+    else:
+        scenes = sorted(scenes, key=ard_tar.get_date)
+
+    windows = get_chip_windows(h, v, chip_ids)
+
+    results = {}
+
+    for scene, result, _, error in scene_pool.run_scenes(read_chips, scenes, args=(windows,), workers=workers,
+                                                         cache_mb=cache_mb):
+        if error is not None:
+            print(f"Skipping {scene}\n    {error}")
+            continue
+
+        results[scene] = result
+
+    # Results arrive as the scenes finish, put them back in date order
+    kept = [scene for scene in scenes if scene in results]
+    arrays = [results[scene] for scene in kept]
+
+    if len(arrays) > 0:
+        tc = np.stack(arrays, axis=1)
+
+    else:
+        tc = np.zeros((len(chip_ids), 0, len(TC_BANDS), CHIP_PIXELS, CHIP_PIXELS), dtype=np.int16)
+
+    return ChipSeries(chip_ids=chip_ids, dates=[ard_tar.get_date(scene) for scene in kept],
+                      sensors=[get_sensor(scene) for scene in kept], scenes=kept, tc=tc)
+
+
+def main_work(ard_dir, out_file, tile_hv, chip_ids, workers=1, cache_mb=None):
+    """
+    Save the chip time series to a .npz file with the arrays chip_ids, dates, sensors, scenes, and tc
+    :param ard_dir: <str>
+    :param out_file: <str>
+    :param tile_hv: <list, int>
+    :param chip_ids: <list, int>
+    :param workers: <int>
+    :param cache_mb: <int>
+    :return:
+    """
+    if not all(1 <= chip_id <= 2500 for chip_id in chip_ids):
+        print("Chip ids must be between 1 and 2500")
+        sys.exit(1)
+
+    start = time.time()
+
+    series = get_chip_series(tile_hv[0], tile_hv[1], chip_ids, ard_dir=ard_dir, workers=workers, cache_mb=cache_mb)
+
+    if len(series.scenes) == 0:
+        print(f"Could not read any scenes for tile H{tile_hv[0]}V{tile_hv[1]} from {ard_dir}")
+        sys.exit(1)
+
+    out_dir = os.path.dirname(os.path.abspath(out_file))
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    np.savez(out_file, chip_ids=np.array(series.chip_ids), dates=np.array(series.dates),
+             sensors=np.array(series.sensors), scenes=np.array(series.scenes), tc=series.tc)
+
+    print(f"{len(series.chip_ids)} chips from {len(series.scenes)} scenes saved to {out_file} "
+          f"in {time.time() - start:.1f}s")
+
+    return None
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    description = "Calculate the brightness, greenness, and wetness time series of chips within an ARD tile"
+
+    parser = ArgumentParser(description=description)
+
+    parser.add_argument("-i", "--input", dest="ard_dir", type=str, required=True,
+                        help="The full path to the directory containing ARD TA tarfiles")
+    parser.add_argument("-o", "--output", dest="out_file", type=str, required=True,
+                        help="The full path to the output .npz file")
+    parser.add_argument("-hv", "--hv", dest="tile_hv", type=int, required=True, nargs=2, metavar=("HH", "VV"),
+                        help="The ARD tile H and V designation")
+    parser.add_argument("-id", "--chips", dest="chip_ids", type=int, required=True, nargs="+",
+                        help="One or more chip ids, 1 - 2500 numbered row by row from the upper left of the tile")
+    parser.add_argument("-n", "--workers", dest="workers", type=int, required=False, default=1,
+                        help="The number of scenes to read in parallel, default is 1")
+    parser.add_argument("-c", "--cache", dest="cache_mb", type=int, required=False, default=None,
+                        help="The GDAL cache size in MB for each worker")
+
+    args = parser.parse_args()
+
+    main_work(**vars(args))
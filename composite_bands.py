@@ -2,10 +2,33 @@
 
 import os
 import sys
+import time
+import manifest
+import scene_pool
 from rgb2pct import RGB
 from argparse import ArgumentParser
 
 
+def get_outfile(out_dir, fname):
+    """
+    Return the path make_composite writes to
+    :param out_dir: <str>
+    :param fname: <str>
+    :return: <str>
+    """
+    return out_dir + os.sep + fname + "_tc.tif"
+
+
+def composite_scene(item, out_dir):
+    """
+    Call make_composite for a (name, bands) item given to scene_pool.run_scenes
+    :param item: <tuple>
+    :param out_dir: <str>
+    :return:
+    """
+    return make_composite(out_dir, item[0], item[1])
+
+
 def make_composite(out_dir, fname, bands):
     """
 
@@ -17,7 +40,7 @@ def make_composite(out_dir, fname, bands):
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    out_file = out_dir + os.sep + fname + "_tc.tif"
+    out_file = get_outfile(out_dir, fname)
 
     RGB(bright=bands[0], green=bands[1], wet=bands[2], dst_filename=out_file)
 
@@ -56,11 +79,12 @@ def get_files(in_dir, lookfor):
     return flist
 
 
-def main_work(input_dir, output_dir):
+def main_work(input_dir, output_dir, manifest_file=None):
     """
 
     :param input_dir:
     :param output_dir:
+    :param manifest_file: <str> Optional run manifest, scenes it records as done are skipped
     :return:
     """
     if not os.path.exists(output_dir):
@@ -80,8 +104,16 @@ def main_work(input_dir, output_dir):
         print(b, '\n', g, '\n', w, '\n')
         components[name] = (b, g, w)
 
-    for key in components.keys():
-        make_composite(output_dir, key, components[key])
+    tasks = ((name, list(bands), [get_outfile(output_dir, name)], (name, bands)) for name, bands in components.items())
+
+    run_manifest = manifest.Manifest(manifest_file) if manifest_file is not None else None
+
+    start = time.time()
+
+    results = list(manifest.run_stage(run_manifest, "composite_bands", tasks, {}, composite_scene,
+                                      args=(output_dir,)))
+
+    scene_pool.summarize(results, elapsed=time.time() - start)
 
     return None
 
@@ -95,6 +127,10 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--output", dest="output_dir", type=str, required=True,
                         help="The full path to the output directory")
 
+    parser.add_argument("--manifest", dest="manifest_file", type=str, required=False, default=None,
+                        help="The full path to a run manifest, created if it does not exist, scenes it records as "
+                             "done are skipped")
+
     args = parser.parse_args()
 
     main_work(**vars(args))
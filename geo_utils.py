@@ -1,8 +1,78 @@
 from collections import namedtuple
+from collections.abc import Mapping, Sequence
+import functools
 import numpy as np
 
+# Each ARD tile is 50 x 50 chips of 100 x 100 pixels of 30 m
+CHIPS_PER_SIDE = 50
+CHIP_PIXELS = 100
+PIXEL_SIZE = 30
+CHIP_SIZE = CHIP_PIXELS * PIXEL_SIZE
+
+
+@functools.lru_cache(maxsize=None)
+def get_tile(h, v):
+    """
+    Return the ChipExtents for a tile, creating it only once per (h, v)
+
+    :param h:
+    :param v:
+    :return: <ChipExtents>
+    """
+
+    return ChipExtents(h=h, v=v)
+
+
+class ChipUL(Sequence):
+    """Upper left coordinate of each chip, ordered by chip id, calculated when accessed"""
+
+    __slots__ = ("tile",)
+
+    def __init__(self, tile):
+        self.tile = tile
+
+    def __len__(self):
+        return CHIPS_PER_SIDE * CHIPS_PER_SIDE
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            return [self[i] for i in range(*ind.indices(len(self)))]
+
+        if ind < 0:
+            ind += len(self)
+
+        if not 0 <= ind < len(self):
+            raise IndexError(ind)
+
+        extent = self.tile.chip_extent(ind + 1)
+
+        return self.tile.GeoCoordinate(x=extent.x_min, y=extent.y_max)
+
+
+class ChipExtentMap(Mapping):
+    """Chip id (1 - 2500) to GeoExtent, calculated when accessed"""
+
+    __slots__ = ("tile",)
+
+    def __init__(self, tile):
+        self.tile = tile
+
+    def __len__(self):
+        return CHIPS_PER_SIDE * CHIPS_PER_SIDE
+
+    def __iter__(self):
+        return iter(range(1, len(self) + 1))
+
+    def __getitem__(self, chip_id):
+        if not isinstance(chip_id, (int, np.integer)) or not 1 <= chip_id <= len(self):
+            raise KeyError(chip_id)
+
+        return self.tile.chip_extent(chip_id)
+
 
 class ChipExtents:
+    __slots__ = ("H", "V", "TILE_EXTENT", "PIXEL_AFFINE", "_chip_index")
+
     GeoExtent = namedtuple('GeoExtent', ['x_min', 'y_max', 'x_max', 'y_min'])
     GeoAffine = namedtuple('GeoAffine', ['ul_x', 'x_res', 'rot_1', 'ul_y', 'rot_2', 'y_res'])
     GeoCoordinate = namedtuple('GeoCoordinate', ['x', 'y'])
@@ -27,13 +97,103 @@ class ChipExtents:
 
         self.TILE_EXTENT, self.PIXEL_AFFINE = self.geospatial_hv(self.H, self.V)
 
-        self.chip_ulx_coords = [x for x in range(self.TILE_EXTENT.x_min, self.TILE_EXTENT.x_max, 3000)]
-        self.chip_uly_coords = [y for y in range(self.TILE_EXTENT.y_max, self.TILE_EXTENT.y_min, -3000)]
+        self._chip_index = None
+
+    @property
+    def chip_ulx_coords(self):
+        return range(self.TILE_EXTENT.x_min, self.TILE_EXTENT.x_max, CHIP_SIZE)
+
+    @property
+    def chip_uly_coords(self):
+        return range(self.TILE_EXTENT.y_max, self.TILE_EXTENT.y_min, -CHIP_SIZE)
+
+    @property
+    def CHIP_UL(self):
+        return ChipUL(self)
+
+    @property
+    def CHIP_EXTENTS(self):
+        return ChipExtentMap(self)
+
+    @property
+    def chip_index(self):
+        """
+        Structured array of the chip ids and extents, built on first access
+
+        :return: <numpy.ndarray>
+        """
+
+        if self._chip_index is None:
+            chips = np.arange(CHIPS_PER_SIDE * CHIPS_PER_SIDE)
+
+            index = np.empty(chips.size, dtype=[("chip_id", np.int32), ("x_min", np.int64), ("y_max", np.int64),
+                                                ("x_max", np.int64), ("y_min", np.int64)])
+
+            index["chip_id"] = chips + 1
+            index["x_min"] = self.TILE_EXTENT.x_min + chips % CHIPS_PER_SIDE * CHIP_SIZE
+            index["y_max"] = self.TILE_EXTENT.y_max - chips // CHIPS_PER_SIDE * CHIP_SIZE
+            index["x_max"] = index["x_min"] + CHIP_SIZE
+            index["y_min"] = index["y_max"] - CHIP_SIZE
 
-        self.CHIP_UL = [self.GeoCoordinate(x=i, y=j) for j in self.chip_uly_coords for i in self.chip_ulx_coords]
+            index.setflags(write=False)
 
-        self.CHIP_EXTENTS = {ind + 1: self.get_chip_extent(chip_coord[0], chip_coord[1]) for ind, chip_coord in
-                             enumerate(self.CHIP_UL)}
+            self._chip_index = index
+
+        return self._chip_index
+
+    def chip_extent(self, chip_id):
+        """
+        Return the GeoExtent of a chip
+
+        :param chip_id: <int> 1 - 2500, numbered row by row from the upper left
+        :return:
+        """
+
+        ind = chip_id - 1
+
+        return self.get_chip_extent(self.TILE_EXTENT.x_min + ind % CHIPS_PER_SIDE * CHIP_SIZE,
+                                    self.TILE_EXTENT.y_max - ind // CHIPS_PER_SIDE * CHIP_SIZE)
+
+    def rowcol_to_chip(self, row, column):
+        """
+        Return the chip id containing a pixel row/column of the tile, or 0 if it is outside of the tile.
+        Accepts scalars or arrays.
+
+        :param row:
+        :param column:
+        :return:
+        """
+
+        row = np.asarray(row)
+        column = np.asarray(column)
+
+        chip_id = row // CHIP_PIXELS * CHIPS_PER_SIDE + column // CHIP_PIXELS + 1
+
+        inside = (row >= 0) & (row < CHIPS_PER_SIDE * CHIP_PIXELS) & (column >= 0) & \
+                 (column < CHIPS_PER_SIDE * CHIP_PIXELS)
+
+        chip_id = np.where(inside, chip_id, 0)
+
+        return int(chip_id) if chip_id.ndim == 0 else chip_id
+
+    def geo_to_chip(self, x, y):
+        """
+        Return the chip id containing a geo-coordinate, or 0 if it is outside of the tile.  Accepts scalars or
+        arrays.
+
+        :param x:
+        :param y:
+        :return:
+        """
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+
+        # Floor rather than truncate so coordinates just outside the upper left are not counted as inside
+        row = np.floor((self.TILE_EXTENT.y_max - y) / PIXEL_SIZE).astype(np.int64)
+        column = np.floor((x - self.TILE_EXTENT.x_min) / PIXEL_SIZE).astype(np.int64)
+
+        return self.rowcol_to_chip(row, column)
 
     def geo_to_rowcol(self, affine, coord):
         """
@@ -53,6 +213,27 @@ class ChipExtents:
         return self.RowColumn(row=int(row),
                               column=int(col))
 
+    def geo_to_rowcol_array(self, affine, x, y):
+        """
+        Array version of geo_to_rowcol, transforms any number of geo-coordinates at once.  Unlike
+        geo_to_rowcol the results are rounded down, so a point outside the tile never maps to row or column 0.
+
+        :param affine:
+        :param x: <numpy.ndarray> x coordinates
+        :param y: <numpy.ndarray> y coordinates
+        :return: <tuple> (rows, columns) as int64 arrays
+        """
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+
+        row = (y - affine.ul_y - affine.ul_x * affine.rot_2) / affine.y_res
+        col = (x - affine.ul_x - affine.ul_y * affine.rot_1) / affine.x_res
+
+        # Floor rather than truncate toward zero, so points just above or left of the tile get negative
+        # rows or columns instead of 0, as in geo_to_chip
+        return np.floor(row).astype(np.int64), np.floor(col).astype(np.int64)
+
     def rowcol_to_geo(self, affine, rowcol):
         """
         Transform a row/col into a geospatial coordinate given reference affine.
@@ -70,6 +251,24 @@ class ChipExtents:
 
         return self.GeoCoordinate(x=x, y=y)
 
+    def rowcol_to_geo_array(self, affine, rows, columns):
+        """
+        Array version of rowcol_to_geo, transforms any number of rows/columns at once.
+
+        :param affine:
+        :param rows: <numpy.ndarray>
+        :param columns: <numpy.ndarray>
+        :return: <tuple> (x, y) as float64 arrays
+        """
+
+        rows = np.asarray(rows, dtype=np.float64)
+        columns = np.asarray(columns, dtype=np.float64)
+
+        x = affine.ul_x + columns * affine.x_res + rows * affine.rot_1
+        y = affine.ul_y + columns * affine.rot_2 + rows * affine.y_res
+
+        return x, y
+
     def geospatial_hv(self, h, v, loc=CONUS_EXTENT):
         """
         Geospatial extent and 30m affine for a given ARD grid location.
@@ -106,8 +305,6 @@ class ChipExtents:
         :return: 
         """
 
-        chip_array = np.zeros((100, 100))
-
         coord_keys = [(i, j) for i in range(100) for j in range(100)]
 
         pixel_x0 = chip_extent.x_min  # + 15
@@ -116,10 +313,43 @@ class ChipExtents:
         pixel_x_coords = [pixel_x0 + (i * 30) for i in range(100)]
         pixel_y_coords = [pixel_y0 - (i * 30) for i in range(100)]
 
-        pixel_dict = {coord_keys[ind_x + ind_y * 100]: self.GeoCoordinate(x=x, y=y)
-                      for ind_y, y in enumerate(pixel_y_coords)
-                      for ind_x, x in enumerate(pixel_x_coords)}
-
         return {coord_keys[ind_x + ind_y * 100]: self.GeoCoordinate(x=x, y=y)
                 for ind_y, y in enumerate(pixel_y_coords)
                 for ind_x, x in enumerate(pixel_x_coords)}
+
+    def get_pixel_arrays(self, chip_extent):
+        """
+        Generate the pixel ul coordinates of a chip as two (100, 100) float64 arrays indexed [row, column].
+        The arrays are read-only broadcast views of a single row and column of coordinates.
+
+        :param chip_extent:
+        :return: <tuple> (x, y)
+        """
+
+        offsets = np.arange(100, dtype=np.float64) * 30
+
+        x = np.broadcast_to(chip_extent.x_min + offsets, (100, 100))
+        y = np.broadcast_to((chip_extent.y_max - offsets)[:, np.newaxis], (100, 100))
+
+        return x, y
+
+    def get_chip_pixel_arrays(self):
+        """
+        Generate the pixel ul coordinates of every chip in the tile as two (2500, 100, 100) float64 arrays
+        indexed [chip id - 1, row, column], without any Python-level loops.  The arrays are read-only
+        broadcast views, so they take no more memory than a single row and column per chip.
+
+        :return: <tuple> (x, y)
+        """
+
+        chip_ulx = self.chip_index["x_min"]
+        chip_uly = self.chip_index["y_max"]
+
+        offsets = np.arange(100, dtype=np.float64) * 30
+
+        shape = (chip_ulx.size, 100, 100)
+
+        x = np.broadcast_to(chip_ulx[:, np.newaxis, np.newaxis] + offsets, shape)
+        y = np.broadcast_to(chip_uly[:, np.newaxis, np.newaxis] - offsets[:, np.newaxis], shape)
+
+        return x, y
@@ -10,11 +10,15 @@ Author: Dan Zelenak
 Date: 10/18/2017
 
 """
+import csv
+import json
 import os
 
-from geo_utils import ChipExtents
+from geo_utils import get_tile
 from osgeo import gdal
 
+import qa_cache
+
 
 def get_txt(outdir, files, coords, value, hv):
     """
@@ -40,15 +44,66 @@ def get_txt(outdir, files, coords, value, hv):
     return None
 
 
-def get_data(image):
+def get_values(qa_file, rowcols, cache=None):
     """
-    Open the image and its as a numpy array
-    :param image: <str>
-    :return: <numpy.ndarray>
+    Read the QA value at each row/col, opening the file once and reading only a 1x1 window per point
+    :param qa_file: <str>
+    :param rowcols: <list> ChipExtents.RowColumn
+    :param cache: <qa_cache.QACache> Optional cache of previously read values
+    :return: <list>
     """
-    src = gdal.Open(image, gdal.GA_ReadOnly)
+    cached = cache.get_points(qa_file) if cache is not None else {}
+
+    values = [cached.get((rc.row, rc.column)) for rc in rowcols]
+
+    if any(v is None for v in values):
+        src = gdal.Open(qa_file, gdal.GA_ReadOnly)
+
+        if src is None:
+            raise IOError(f"Could not open {qa_file}")
+
+        band = src.GetRasterBand(1)
+
+        read = {}
 
-    return src.GetRasterBand(1).ReadAsArray()
+        for ind, rc in enumerate(rowcols):
+            if values[ind] is None:
+                values[ind] = int(band.ReadAsArray(rc.column, rc.row, 1, 1)[0, 0])
+
+                read[(rc.row, rc.column)] = values[ind]
+
+        if cache is not None:
+            cache.put_points(qa_file, read)
+
+    return values
+
+
+def get_points(points_file):
+    """
+    Read the points from a CSV file with x and y columns and an optional id column, or from a GeoJSON
+    file of Point features
+    :param points_file: <str>
+    :return: <list> (id, x, y)
+    """
+    points = []
+
+    if os.path.splitext(points_file)[1].lower() in (".geojson", ".json"):
+        with open(points_file, "r") as geojson:
+            features = json.load(geojson)["features"]
+
+        for ind, feature in enumerate(features):
+            point_id = feature.get("id", (feature.get("properties") or {}).get("id", ind))
+
+            x, y = feature["geometry"]["coordinates"][:2]
+
+            points.append((str(point_id), float(x), float(y)))
+
+    else:
+        with open(points_file, "r", newline="") as csv_file:
+            for ind, row in enumerate(csv.DictReader(csv_file)):
+                points.append((row.get("id", str(ind)), float(row["x"]), float(row["y"])))
+
+    return points
 
 
 def get_files(directory, lookfor="PIXELQA", ext=".tif"):
@@ -77,26 +132,27 @@ def get_files(directory, lookfor="PIXELQA", ext=".tif"):
     return flist
 
 
-def check_value(qa_file, value, rowcol):
+def check_value(qa_file, value, rowcol, cache=None):
     """
     Check the QAMap at the given coordinates for the given value
     :param qa_file: <str>
     :param value: <int>
     :param rowcol: <namedtuple ChipExtents.GeoCoordinate> rowcol.row, rowcol.col
+    :param cache: <qa_cache.QACache> Optional cache of previously checked values
     :return:
     """
-    qa_data = get_data(qa_file)
-
     print(f"Checking file {os.path.basename(qa_file)}")
 
-    if not qa_data[rowcol.row, rowcol.column] == value:
+    qa_value = get_values(qa_file, [rowcol], cache)[0]
+
+    if not qa_value == value:
         return True
 
     else:
         return False
 
 
-def main_work(ard_dir, output_dir, coords, qa_value, tile_hv):
+def main_work(ard_dir, output_dir, coords, qa_value, tile_hv, cache_file=None):
     """
 
     :param ard_dir: <str>
@@ -104,9 +160,10 @@ def main_work(ard_dir, output_dir, coords, qa_value, tile_hv):
     :param coords: <list>
     :param qa_value: <int>
     :param tile_hv: <list, int>
+    :param cache_file: <str> Optional QA cache, points already checked are not read again
     :return:
     """
-    chip_info = ChipExtents(h=tile_hv[0], v=tile_hv[1])
+    chip_info = get_tile(tile_hv[0], tile_hv[1])
 
     geo_coord = chip_info.GeoCoordinate(x=coords[0], y=coords[1])
 
@@ -118,13 +175,64 @@ def main_work(ard_dir, output_dir, coords, qa_value, tile_hv):
 
     # print(input_list)
 
-    file_list = [os.path.split(i)[0] for i in input_list if check_value(i, qa_value, row_col) is True]
+    cache = qa_cache.QACache(cache_file) if cache_file is not None else None
+
+    file_list = [os.path.split(i)[0] for i in input_list if check_value(i, qa_value, row_col, cache) is True]
 
     get_txt(output_dir, file_list, coords, qa_value, tile_hv)
 
     return None
 
 
+def batch_work(ard_dir, output_dir, points_file, tile_hv, cache_file=None):
+    """
+    Write the QA value of every point in every scene to point_values.csv in the output directory
+    :param ard_dir: <str>
+    :param output_dir: <str>
+    :param points_file: <str> CSV or GeoJSON of points, see get_points
+    :param tile_hv: <list, int>
+    :param cache_file: <str> Optional QA cache, points already checked are not read again
+    :return:
+    """
+    chip_info = get_tile(tile_hv[0], tile_hv[1])
+
+    all_points = get_points(points_file)
+
+    rows, cols = chip_info.geo_to_rowcol_array(chip_info.PIXEL_AFFINE, [p[1] for p in all_points],
+                                               [p[2] for p in all_points])
+
+    points, rowcols = [], []
+
+    for point, row, col in zip(all_points, rows.tolist(), cols.tolist()):
+        if 0 <= row < 5000 and 0 <= col < 5000:
+            points.append(point)
+            rowcols.append(chip_info.RowColumn(row=row, column=col))
+
+        else:
+            print(f"Point {point[0]} ({point[1]}, {point[2]}) is outside of tile H{tile_hv[0]}V{tile_hv[1]}, "
+                  f"skipping it")
+
+    cache = qa_cache.QACache(cache_file) if cache_file is not None else None
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    with open(f"{output_dir}{os.sep}point_values.csv", "w", newline="") as out_file:
+        writer = csv.writer(out_file)
+
+        writer.writerow(["scene", "id", "x", "y", "row", "col", "qa"])
+
+        for qa_file in get_files(ard_dir):
+            print(f"Checking file {os.path.basename(qa_file)}")
+
+            values = get_values(qa_file, rowcols, cache)
+
+            for (point_id, x, y), rowcol, value in zip(points, rowcols, values):
+                writer.writerow([os.path.split(qa_file)[0], point_id, x, y, rowcol.row, rowcol.column, value])
+
+    return None
+
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
 
@@ -137,13 +245,27 @@ if __name__ == "__main__":
                         help="The full path to the directory containing ARD TA tarfiles")
     parser.add_argument("-o", "--output", dest="output_dir", type=str, required=True,
                         help="The full path to the output directory")
-    parser.add_argument("-xy", "--xy", dest="coords", type=int, required=True, nargs=2, metavar=("X-coord", "Y-coord"),
+    parser.add_argument("-xy", "--xy", dest="coords", type=int, required=False, nargs=2, metavar=("X-coord", "Y-coord"),
                         help="The x and y coordinates used to test for target imagery")
+    parser.add_argument("-p", "--points", dest="points_file", type=str, required=False, default=None,
+                        help="A CSV (x, y, and optional id columns) or GeoJSON of points, writes the QA value of "
+                             "every point in every scene to point_values.csv instead of filtering the scenes")
     parser.add_argument("-hv", "--hv", dest="tile_hv", type=int, required=True, nargs=2, metavar=("HH", "VV"),
                         help="The ARD tile H and V designation")
     parser.add_argument("-qa", "--qa", dest="qa_value", type=int, required=False, default=1,
                         help="The QA value used to determine if a scene is valid")
+    parser.add_argument("--qa-cache", dest="cache_file", type=str, required=False, default=None,
+                        help="The full path to a QA cache file, created if it does not exist")
 
     args = parser.parse_args()
 
-    main_work(**vars(args))
+    if args.points_file is not None:
+        batch_work(ard_dir=args.ard_dir, output_dir=args.output_dir, points_file=args.points_file,
+                   tile_hv=args.tile_hv, cache_file=args.cache_file)
+
+    elif args.coords is not None:
+        main_work(ard_dir=args.ard_dir, output_dir=args.output_dir, coords=args.coords, qa_value=args.qa_value,
+                  tile_hv=args.tile_hv, cache_file=args.cache_file)
+
+    else:
+        parser.error("Either -xy or -p must be specified")
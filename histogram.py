@@ -0,0 +1,87 @@
+"""
+Exact percentiles of Int16 rasters from integer histograms.  The histogram is built with np.bincount in
+a single O(N) pass and any number of percentiles are then read from its cumulative counts without
+sorting the data.
+"""
+
+import numpy as np
+
+# Value v is counted in bin v + OFFSET so that the whole Int16 range maps to NBINS bins
+OFFSET = 32768
+NBINS = 65536
+
+
+def get_histogram(array, mask=None, hist=None):
+    """
+    Count the occurrences of each Int16 value
+    :param array: <numpy.ndarray> Integer data within the Int16 range
+    :param mask: <numpy.ndarray> Optional boolean mask of the values to count
+    :param hist: <numpy.ndarray> Optional histogram to add the counts to
+    :return: <numpy.ndarray> (NBINS,) int64
+    """
+    values = array[mask] if mask is not None else array.ravel()
+
+    counts = np.bincount(np.add(values, OFFSET, dtype=np.intp), minlength=NBINS)
+
+    if hist is None:
+        return counts
+
+    hist += counts
+
+    return hist
+
+
+def get_percentiles(hist, percentiles):
+    """
+    Return the percentiles of the counted values, matching np.percentile with linear interpolation
+    :param hist: <numpy.ndarray> Histogram from get_histogram
+    :param percentiles: <list> Percentiles between 0 and 100
+    :return: <list>
+    """
+    cumulative = np.cumsum(hist)
+
+    total = cumulative[-1]
+
+    if total == 0:
+        raise ValueError("Cannot calculate percentiles of an empty histogram")
+
+    results = []
+
+    for p in percentiles:
+        rank = p / 100.0 * (total - 1)
+
+        lower = int(np.floor(rank))
+
+        # The k-th smallest value (counting from 0) is in the first bin whose cumulative count exceeds k
+        v_lower = np.searchsorted(cumulative, lower, side="right")
+        v_upper = np.searchsorted(cumulative, min(lower + 1, total - 1), side="right")
+
+        results.append(float(v_lower - OFFSET) + (rank - lower) * float(v_upper - v_lower))
+
+    return results
+
+
+def write_sidecar(path, hists):
+    """
+    Save named histograms to a compressed .npz file
+    :param path: <str>
+    :param hists: <dict> Name to histogram
+    :return:
+    """
+    np.savez_compressed(path, **hists)
+
+    return None
+
+
+def read_sidecar(path):
+    """
+    Load the histograms saved by write_sidecar, or None if the file does not exist
+    :param path: <str>
+    :return: <dict>
+    """
+    try:
+        with np.load(path) as sidecar:
+            return {key: sidecar[key] for key in sidecar.files}
+
+    except IOError:
+        return None
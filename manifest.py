@@ -0,0 +1,213 @@
+"""
+Record which scenes each pipeline stage has finished in a SQLite file, so a re-run only processes scenes
+that are new, whose inputs or parameters changed, or whose outputs are missing or were changed since.
+Files are identified by their size and modification time rather than a hash of their contents, which for
+the ARD archives would take as long to read as the stages themselves.
+
+A scene is marked running before it is processed and done once its outputs are written.  A scene left
+running by a crash is processed again, and any outputs it may have half-written are removed first.
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+import scene_pool
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    stage TEXT,
+    scene TEXT,
+    inputs TEXT,
+    params TEXT,
+    outputs TEXT,
+    state TEXT,
+    error TEXT,
+    updated REAL,
+    PRIMARY KEY (stage, scene)
+);
+"""
+
+
+def get_signature(path):
+    """
+    :param path: <str>
+    :return: <list> [size, modification time in ns], None if the file does not exist
+    """
+    try:
+        stat = os.stat(path)
+
+    except OSError:
+        return None
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_signatures(paths):
+    """
+    :param paths: <list>
+    :return: <dict> Absolute path to signature
+    """
+    return {os.path.abspath(path): get_signature(path) for path in paths}
+
+
+def to_json(value):
+    """
+    Serialize with sorted keys so the same parameters always compare equal
+    :param value:
+    :return: <str>
+    """
+    return json.dumps(value, sort_keys=True)
+
+
+class Manifest:
+    def __init__(self, path):
+        """
+
+        :param path: <str> The SQLite file, created if it does not exist
+        """
+        self.path = path
+
+        folder = os.path.dirname(os.path.abspath(path))
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.conn = sqlite3.connect(path, timeout=60)
+
+        self.conn.executescript(SCHEMA)
+
+    def is_done(self, stage, scene, inputs, params, outputs):
+        """
+        Return True if the stage finished the scene with the same inputs and parameters, and every output
+        is unchanged since
+        :param stage: <str>
+        :param scene: <str>
+        :param inputs: <list> Input file paths
+        :param params: <dict> Parameters that change the outputs
+        :param outputs: <list> Output file paths
+        :return: <bool>
+        """
+        row = self.conn.execute("SELECT inputs, params, outputs, state FROM tasks WHERE stage = ? AND scene = ?",
+                                (stage, scene)).fetchone()
+
+        if row is None or row[3] != "done":
+            return False
+
+        if row[0] != to_json(get_signatures(inputs)) or row[1] != to_json(params):
+            return False
+
+        recorded = json.loads(row[2])
+
+        current = get_signatures(outputs)
+
+        return all(sig is not None and recorded.get(path) == sig for path, sig in current.items())
+
+    def start(self, stage, scene, inputs, params, outputs):
+        """
+        Mark the scene running, removing any existing outputs so a stage never keeps a half-written file
+        :param stage: <str>
+        :param scene: <str>
+        :param inputs: <list>
+        :param params: <dict>
+        :param outputs: <list>
+        :return:
+        """
+        for path in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (stage, scene, to_json(get_signatures(inputs)), to_json(params),
+                               to_json(dict.fromkeys(map(os.path.abspath, outputs))), "running", None,
+                               time.time()))
+
+        return None
+
+    def finish(self, stage, scene, outputs):
+        """
+        Mark the scene done, recording the signature of each output
+        :param stage: <str>
+        :param scene: <str>
+        :param outputs: <list>
+        :return:
+        """
+        signatures = get_signatures(outputs)
+
+        missing = [path for path, sig in signatures.items() if sig is None]
+
+        if len(missing) > 0:
+            return self.fail(stage, scene, f"Outputs were not written: {missing}")
+
+        with self.conn:
+            self.conn.execute("UPDATE tasks SET outputs = ?, state = 'done', error = NULL, updated = ? "
+                              "WHERE stage = ? AND scene = ?", (to_json(signatures), time.time(), stage, scene))
+
+        return None
+
+    def fail(self, stage, scene, error):
+        """
+        :param stage: <str>
+        :param scene: <str>
+        :param error: <str>
+        :return:
+        """
+        with self.conn:
+            self.conn.execute("UPDATE tasks SET state = 'failed', error = ?, updated = ? WHERE stage = ? AND scene = ?",
+                              (error, time.time(), stage, scene))
+
+        return None
+
+    def close(self):
+        self.conn.close()
+
+
+def run_stage(manifest, stage, tasks, params, func, args=(), **kwargs):
+    """
+    Run func over the scenes of a stage with scene_pool.run_scenes, skipping scenes the manifest records
+    as done.  Tasks are read lazily, so a generator keeps streaming into the pool.
+    :param manifest: <Manifest> None runs every task without a manifest
+    :param stage: <str>
+    :param tasks: <iterable> (scene, inputs, outputs, item) where item is what func is called with
+    :param params: <dict> Parameters that change the outputs
+    :param func: <function>
+    :param args: <tuple>
+    :param kwargs: Passed to scene_pool.run_scenes
+    :return: <generator> Results of run_scenes for the scenes that were run
+    """
+    if manifest is None:
+        yield from scene_pool.run_scenes(func, (task[3] for task in tasks), args=args, **kwargs)
+        return
+
+    # Each result carries the item object it was submitted with, so results are matched to their scene
+    # whatever order they finish in
+    submitted = {}
+
+    def get_items():
+        skipped = 0
+
+        for scene, inputs, outputs, item in tasks:
+            if manifest.is_done(stage, scene, inputs, params, outputs):
+                skipped += 1
+                continue
+
+            manifest.start(stage, scene, inputs, params, outputs)
+
+            submitted[id(item)] = (scene, outputs, item)
+
+            yield item
+
+        print(f"{stage}: {skipped} scenes already done according to {manifest.path}")
+
+    for result in scene_pool.run_scenes(func, get_items(), args=args, **kwargs):
+        scene, outputs, _ = submitted.pop(id(result[0]))
+
+        if result[3] is None:
+            manifest.finish(stage, scene, outputs)
+
+        else:
+            manifest.fail(stage, scene, result[3])
+
+        yield result
@@ -0,0 +1,146 @@
+"""
+Read the bands of the uncompressed *_TAstack.tif files made by stack_ard_source.py as read-only memory
+mapped views of the file, so no band is copied into a new array.  Stacks that are compressed, tiled, or
+whose strips are not stored one after another in the file are read with GDAL instead.
+"""
+
+import os
+
+import numpy as np
+from osgeo import gdal_array
+
+
+def find_stacks(directory, product="TA"):
+    """
+    Return the sorted paths to all stacks of the given product type under directory
+    :param directory: <str>
+    :param product: <str>
+    :return: <list>
+    """
+    stacks = []
+
+    for root, folders, files in os.walk(directory):
+        for file in files:
+            if file.endswith(f"_{product}stack.tif"):
+                stacks.append(os.path.join(root, file))
+
+    return sorted(stacks)
+
+
+def is_stack(scene):
+    """
+    :param scene: <str>
+    :return: <bool>
+    """
+    return scene.endswith("stack.tif")
+
+
+def get_byte_order(path):
+    """
+    Return the numpy byte order of a TIFF file from its header
+    :param path: <str>
+    :return: <str> "<" or ">", None if the file is not a TIFF
+    """
+    with open(path, "rb") as tif:
+        header = tif.read(2)
+
+    return {b"II": "<", b"MM": ">"}.get(header)
+
+
+def get_layout(ds):
+    """
+    Find where the pixels of each band start in the file.  The strips of a band (or of all bands when
+    pixel interleaved) must follow one another without gaps so the band can be mapped as one array.
+    :param ds: <gdal.Dataset>
+    :return: <tuple> (interleave, numpy dtype, list of band offsets), None if the stack can not be mapped
+    """
+    path = ds.GetDescription()
+
+    if ds.GetDriver().ShortName != "GTiff" or not os.path.isfile(path):
+        return None
+
+    if ds.GetMetadataItem("COMPRESSION", "IMAGE_STRUCTURE") not in (None, "NONE"):
+        return None
+
+    first = ds.GetRasterBand(1)
+
+    block_cols, block_rows = first.GetBlockSize()
+
+    # Tiled files are not stored row by row
+    if block_cols != ds.RasterXSize:
+        return None
+
+    byte_order = get_byte_order(path)
+
+    if byte_order is None:
+        return None
+
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(first.DataType)).newbyteorder(byte_order)
+
+    interleave = ds.GetMetadataItem("INTERLEAVE", "IMAGE_STRUCTURE") or "PIXEL"
+
+    if interleave == "PIXEL":
+        bands = [first]
+        strip_bytes = block_rows * ds.RasterXSize * ds.RasterCount * dtype.itemsize
+
+    else:
+        bands = [ds.GetRasterBand(i + 1) for i in range(ds.RasterCount)]
+        strip_bytes = block_rows * ds.RasterXSize * dtype.itemsize
+
+    strips = -(-ds.RasterYSize // block_rows)
+
+    offsets = []
+
+    for band in bands:
+        starts = [band.GetMetadataItem(f"BLOCK_OFFSET_0_{strip}", "TIFF") for strip in range(strips)]
+
+        if None in starts:
+            return None
+
+        starts = [int(start) for start in starts]
+
+        if any(start != starts[0] + strip * strip_bytes for strip, start in enumerate(starts)):
+            return None
+
+        offsets.append(starts[0])
+
+    return interleave, dtype, offsets
+
+
+def open_stack(ds, keys):
+    """
+    Return each band of the stack as an array, memory mapped if possible
+    :param ds: <gdal.Dataset>
+    :param keys: <list> Name for each band of the stack in order, "QA" is viewed as unsigned 16-bit
+    :return: <dict> Name to (rows, columns) array
+    """
+    layout = get_layout(ds)
+
+    if layout is None:
+        print(f"{ds.GetDescription()} can not be memory mapped, reading it with GDAL")
+
+        arrays = {key: ds.GetRasterBand(ind + 1).ReadAsArray() for ind, key in enumerate(keys)}
+
+    else:
+        interleave, dtype, offsets = layout
+
+        path = ds.GetDescription()
+
+        rows, cols = ds.RasterYSize, ds.RasterXSize
+
+        if interleave == "PIXEL":
+            pixels = np.memmap(path, dtype=dtype, mode="r", offset=offsets[0], shape=(rows, cols, ds.RasterCount))
+
+            arrays = {key: pixels[:, :, ind] for ind, key in enumerate(keys)}
+
+        else:
+            arrays = {key: np.memmap(path, dtype=dtype, mode="r", offset=offsets[ind], shape=(rows, cols))
+                      for ind, key in enumerate(keys)}
+
+    # stack_ard_source.py stores the PIXELQA with the Int16 type of the reflectance bands
+    if "QA" in arrays and arrays["QA"].dtype.kind == "i":
+        qa_dtype = arrays["QA"].dtype
+
+        arrays["QA"] = arrays["QA"].view(np.dtype(f"{qa_dtype.byteorder}u{qa_dtype.itemsize}"))
+
+    return arrays
@@ -0,0 +1,172 @@
+"""
+Run the whole workflow on each scene in a single process: the optional cloud cover selection, the TC
+transform, the percentile clip and rescale, and the color tables and RGB composite.  The TC and rescaled
+bands are handed from one stage to the next as in-memory GDAL datasets under /vsimem/, so only the final
+color and composite rasters are written to disk unless the intermediates are kept with --keep.
+"""
+
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+from osgeo import gdal
+
+import add_color
+import ard_tar
+import composite_bands
+import pixelqa_scene_filter
+import rescale
+import scene_pool
+import tasseled_cap
+from tasseled_cap import MULTIBAND, TC_BANDS
+
+# Each scene's intermediates are kept in memory under this folder unless they are kept on disk
+VSIMEM = "/vsimem/pipeline"
+
+
+def get_outputs(scene, output_dir):
+    """
+    Return the final products of a scene, the three colored TC bands and the RGB composite
+    :param scene: <str>
+    :param output_dir: <str>
+    :return: <list>
+    """
+    entity_id = ard_tar.get_entity_id(scene)
+
+    outputs = [add_color.get_outfile(output_dir, f"{entity_id}_{key}.tif", key) for key in TC_BANDS]
+
+    outputs.append(composite_bands.get_outfile(f"{output_dir}{os.sep}composite", entity_id))
+
+    return outputs
+
+
+def run_scene(scene, output_dir, keep=False, cloud_threshold=None, step=1, kernel="float", stats="exact"):
+    """
+    Run every stage on one scene
+    :param scene: <str> The scene's .tar archive
+    :param output_dir: <str>
+    :param keep: <bool> Write the TC and rescaled bands to output_dir/tc and output_dir/rescale
+    :param cloud_threshold: <int> Skip the scene if its cloud cover percent is above this, None keeps every scene
+    :param step: <int> Decimation factor of the PIXELQA read for the cloud cover
+    :param kernel: <str> The TC kernel, see tasseled_cap.KERNELS
+    :param stats: <str> exact, approx, or none, for the rescaled bands
+    :return: <list> The final products, empty if the scene was not selected
+    """
+    if cloud_threshold is not None:
+        summary = pixelqa_scene_filter.check_scene(scene, step=step)
+
+        # Percent of the scene covered by clouds, the same as pixelqa_scene_filter.main_work
+        cloud_cover = 100 - int(summary["clear_fraction"] * 100)
+
+        if cloud_cover > cloud_threshold:
+            print(f"Skipping {scene} with {cloud_cover}% cloud cover")
+
+            return []
+
+    entity_id = ard_tar.get_entity_id(scene)
+
+    work_dir = output_dir if keep else f"{VSIMEM}/{entity_id}"
+
+    tc_dir = f"{work_dir}{os.sep}tc"
+
+    rescale_dir = f"{work_dir}{os.sep}rescale"
+
+    try:
+        tasseled_cap.calculate_tc(scene, tc_dir, window_rows=100, multiband=True,
+                                  options=tasseled_cap.get_creation_options(), kernel=kernel)
+
+        tc_file = tasseled_cap.get_outfile(src=scene, tc_band=MULTIBAND, out_dir=tc_dir)
+
+        tc_files = {key: (tc_file, band) for band, key in enumerate(TC_BANDS, start=1)}
+
+        rescale.rescale_scene((scene, tc_files), rescale_dir, stats=stats)
+
+        rescaled = [rescale.get_outfile(tc_file, rescale_dir, key) for key in TC_BANDS]
+
+        for file, key in zip(rescaled, TC_BANDS):
+            add_color.set_color(outdir=output_dir, infile=file, tc_band=key)
+
+        composite_bands.make_composite(f"{output_dir}{os.sep}composite", entity_id, rescaled)
+
+    finally:
+        if not keep:
+            gdal.RmdirRecursive(work_dir)
+
+    return get_outputs(scene, output_dir)
+
+
+def main_work(output_dir, ard_dir=None, txt_file=None, keep=False, cloud_threshold=None, step=1, kernel="float",
+              stats="exact", workers=1, cache_mb=None):
+    """
+
+    :param output_dir: <str>
+    :param ard_dir: <str>
+    :param txt_file: <str>
+    :param keep: <bool> Also write the TC and rescaled bands
+    :param cloud_threshold: <int> Maximum cloud cover percent, None keeps every scene
+    :param step: <int> Decimation factor of the PIXELQA read for the cloud cover
+    :param kernel: <str>
+    :param stats: <str>
+    :param workers: <int> The number of scenes to process in parallel
+    :param cache_mb: <int> The GDAL cache size in megabytes for each worker
+    :return:
+    """
+    if txt_file is None and ard_dir is not None:
+        file_list = ard_tar.find_archives(directory=ard_dir)
+
+    elif ard_dir is None and txt_file is not None:
+        with open(txt_file, "r") as input_file:
+            file_list = [line[:-1] for line in input_file if ".tar" in line]
+
+    else:
+        print("Either an input directory (-i) or a file list (-f) must be specified")
+        sys.exit(1)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    start = time.time()
+
+    results = list(scene_pool.run_scenes(run_scene, file_list,
+                                         args=(output_dir, keep, cloud_threshold, step, kernel, stats),
+                                         workers=workers, cache_mb=cache_mb))
+
+    scene_pool.summarize(results, elapsed=time.time() - start)
+
+    if cloud_threshold is not None:
+        selected = [scene for scene, outputs, _, error in results if error is None and len(outputs) > 0]
+
+        print(f"{len(selected)} of {len(results)} scenes had at most {cloud_threshold}% cloud cover")
+
+    return None
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Calculate, rescale, and color the TC bands of each scene in one pass")
+
+    parser.add_argument("-i", "--input", dest="ard_dir", type=str, required=False, default=None,
+                        help="The full path to a directory containing ARD .tar archives")
+    parser.add_argument("-f", "--file", dest="txt_file", type=str, required=False, default=None,
+                        help="The full path to a .txt file listing the .tar archives, e.g. from get_scenes.py")
+    parser.add_argument("-o", "--output", dest="output_dir", type=str, required=True,
+                        help="The full path to the output root directory")
+    parser.add_argument("--keep", dest="keep", action="store_true",
+                        help="Also write the TC bands to OUTPUT/tc and the rescaled bands to OUTPUT/rescale")
+    parser.add_argument("-cc", dest="cloud_threshold", type=int, required=False, default=None, metavar="0 - 100",
+                        help="Skip scenes with more than this percent of cloud cover, by default every scene is run")
+    parser.add_argument("--step", dest="step", type=int, required=False, default=1,
+                        help="Estimate the cloud cover from every step-th PIXELQA pixel, default is 1 (exact)")
+    parser.add_argument("--kernel", dest="kernel", type=str, required=False, default="float",
+                        choices=list(tasseled_cap.KERNELS), help="The TC kernel, see tasseled_cap.py, default is float")
+    parser.add_argument("-s", "--stats", dest="stats", type=str, required=False, default="exact",
+                        choices=["exact", "approx", "none"],
+                        help="How the statistics of the rescaled bands are calculated, default is exact")
+    parser.add_argument("-n", "--workers", dest="workers", type=int, required=False, default=1,
+                        help="The number of scenes to process in parallel, default is 1")
+    parser.add_argument("-c", "--cache", dest="cache_mb", type=int, required=False, default=None,
+                        help="The GDAL cache size in MB for each worker")
+
+    args = parser.parse_args()
+
+    main_work(**vars(args))
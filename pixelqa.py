@@ -0,0 +1,118 @@
+"""
+Decode the Landsat Collection 1 ARD PIXELQA bit flags.  Every possible 16-bit PIXELQA value is decoded
+once per sensor into a 65536 entry lookup table of packed flags, so a whole band is decoded with a single
+table lookup instead of comparing it against individual PIXELQA values.
+
+PIXELQA bits:
+    0 fill, 1 clear, 2 water, 3 cloud shadow, 4 snow, 5 cloud, 6-7 cloud confidence,
+    8-9 cirrus confidence (L8 only), 10 terrain occlusion (L8 only)
+"""
+
+import functools
+
+import numpy as np
+
+# Packed flags returned by decode, one bit each
+FILL = 1
+CLEAR = 2
+WATER = 4
+SHADOW = 8
+SNOW = 16
+CLOUD = 32
+
+# Confidence levels stored in the 2-bit confidence fields
+CONF_NONE, CONF_LOW, CONF_MEDIUM, CONF_HIGH = 0, 1, 2, 3
+
+
+@functools.lru_cache(maxsize=None)
+def get_lut(sensor):
+    """
+    Return the lookup table of packed flags for every PIXELQA value.  A pixel is CLEAR if it is a clear
+    land or water observation, not fill, cloud, cloud shadow, or snow, with at most low cloud confidence,
+    and for L8 at most low cirrus confidence and no terrain occlusion.
+    :param sensor: <str> L4, L5, L7, or L8
+    :return: <numpy.ndarray> (65536,) uint8
+    """
+    values = np.arange(65536, dtype=np.uint32)
+
+    def bit(b):
+        return ((values >> b) & 1).astype(bool)
+
+    fill, water, shadow, snow, cloud = bit(0), bit(2), bit(3), bit(4), bit(5)
+
+    clear = (bit(1) | water) & ~(fill | shadow | snow | cloud) & ((values >> 6) & 3 <= CONF_LOW)
+
+    if sensor == "L8":
+        clear &= ((values >> 8) & 3 <= CONF_LOW) & ~bit(10)
+
+    lut = np.zeros(65536, dtype=np.uint8)
+
+    for mask, flag in ((fill, FILL), (clear, CLEAR), (water, WATER), (shadow, SHADOW), (snow, SNOW),
+                       (cloud, CLOUD)):
+        lut[mask] |= flag
+
+    lut.setflags(write=False)
+
+    return lut
+
+
+def decode(qa, sensor):
+    """
+    Decode PIXELQA into packed flags
+    :param qa: <numpy.ndarray> PIXELQA, unsigned 16-bit
+    :param sensor: <str>
+    :return: <numpy.ndarray> uint8 flags with the same shape as qa
+    """
+    return get_lut(sensor)[qa]
+
+
+def get_valid_mask(qa):
+    """
+    Return a boolean mask of the pixels that are not fill
+    :param qa: <numpy.ndarray> PIXELQA
+    :return: <numpy.ndarray>
+    """
+    return (qa & FILL) == 0
+
+
+def get_masks(qa, sensor):
+    """
+    Return boolean masks of the clear pixels and of the pixels that are not fill
+    :param qa: <numpy.ndarray> PIXELQA
+    :param sensor: <str>
+    :return: <tuple> (mask_clear, mask_fill)
+    """
+    flags = decode(qa, sensor)
+
+    return (flags & CLEAR) != 0, (flags & FILL) == 0
+
+
+def count_values(qa):
+    """
+    Count the pixels with each PIXELQA value
+    :param qa: <numpy.ndarray> PIXELQA
+    :return: <numpy.ndarray> (65536,) int64
+    """
+    return np.bincount(qa.ravel(), minlength=65536)
+
+
+def count_flags(qa, sensor, counts=None):
+    """
+    Count the pixels with each flag in a single pass over the PIXELQA
+    :param qa: <numpy.ndarray> PIXELQA
+    :param sensor: <str>
+    :param counts: <numpy.ndarray> Optional result of count_values for qa
+    :return: <dict> Flag name to pixel count, plus "total"
+    """
+    if counts is None:
+        counts = count_values(qa)
+
+    lut = get_lut(sensor)
+
+    names = {"fill": FILL, "clear": CLEAR, "water": WATER, "shadow": SHADOW, "snow": SNOW, "cloud": CLOUD}
+
+    results = {name: int(counts[(lut & flag) != 0].sum()) for name, flag in names.items()}
+
+    results["total"] = int(qa.size)
+
+    return results
@@ -1,13 +1,18 @@
 
 """Calculate the percent of clear land and water pixels within a scene"""
 
+import math
 import os
 import sys
+import time
 from argparse import ArgumentParser
-import numpy as np
 
 from osgeo import gdal
 
+import ard_tar
+import qa_cache
+import scene_pool
+
 
 def write_to_txt(scenes, out_dir):
     """
@@ -28,26 +33,6 @@ def write_to_txt(scenes, out_dir):
     return None
 
 
-def get_cloud_cover(pixelqa, vals):
-    """
-
-    :param pixelqa:
-    :param vals:
-    :return:
-    """
-    counting_mask = np.zeros_like(pixelqa, dtype=np.bool)
-
-    for v in vals:
-        counting_mask[pixelqa == v] = True
-
-    total_clear = np.sum(counting_mask)
-
-    total = np.sum(np.ones_like(pixelqa))
-
-    # Return the percent of scene covered by clouds
-    return 100 - int(total_clear / total * 100)
-
-
 def get_sensor(in_tar):
     """
 
@@ -57,32 +42,63 @@ def get_sensor(in_tar):
     return os.path.basename(in_tar)[0] + os.path.basename(in_tar)[3]
 
 
-def get_pixelqa(in_tar):
+def get_error_bound(n):
+    """
+    Return the 95% confidence half-width, in percent, of a cloud cover estimated from n sampled pixels.
+    Uses the worst case binomial standard error 0.5 / sqrt(n).  The regular grid sample is not random but
+    cloud cover is spatially smooth, so in practice the error is smaller than this.
+    :param n: <int>
+    :return: <float>
     """
+    return 1.96 * 0.5 / math.sqrt(n) * 100
 
+
+def get_pixelqa(in_tar, step=1):
+    """
+    Read the PIXELQA, optionally decimated by step in each direction.  A decimated read uses nearest
+    neighbour sampling, so only every step-th pixel (or an existing overview) is read.
     :param in_tar:
+    :param step: <int> 1 reads every pixel
     :return:
     """
-    basename = os.path.basename(in_tar)[:-7]
-
-    arch_qa = f"{in_tar}{os.sep}{basename}_PIXELQA.tif"
+    arch_qa = ard_tar.get_band_path(in_tar, "PIXELQA")
 
     src = gdal.Open(arch_qa, gdal.GA_ReadOnly)
 
     if src is None:
-        print("Could not open PIXELQA file {arch_qa}")
+        print(f"Could not open PIXELQA file {arch_qa}")
 
         sys.exit(1)
 
-    return src.GetRasterBand(1).ReadAsArray()
+    band = src.GetRasterBand(1)
 
+    if step <= 1:
+        return band.ReadAsArray()
 
-def main_work(file_list, outdir, cloud_threshold=10):
+    return band.ReadAsArray(buf_xsize=max(1, band.XSize // step), buf_ysize=max(1, band.YSize // step))
+
+
+def check_scene(in_tar, step=1):
+    """
+    Return the PIXELQA summary of a scene, see qa_cache.summarize_qa
+    :param in_tar: <str>
+    :param step: <int> Decimation factor of the PIXELQA read
+    :return: <dict>
+    """
+    print(f"Checking file {in_tar}\n")
+
+    return qa_cache.summarize_qa(get_pixelqa(in_tar, step=step), get_sensor(in_tar), step=step)
+
+
+def main_work(file_list, outdir, cloud_threshold=10, step=1, workers=1, cache_file=None):
     """
 
     :param file_list:
     :param outdir:
     :param cloud_threshold:
+    :param step: <int> Decimation factor of the PIXELQA reads, 1 is exact
+    :param workers: <int> The number of scenes to check in parallel
+    :param cache_file: <str> Optional QA summary cache, scenes already in the cache are not read again
     :return:
     """
     with open(file_list, "r") as tar_list:
@@ -93,28 +109,44 @@ def main_work(file_list, outdir, cloud_threshold=10):
 
         sys.exit(1)
 
-    filtered = []
+    if step > 1:
+        # ARD tiles are 5000 x 5000 pixels
+        print(f"Fast scan reading every {step}th pixel, cloud cover is within "
+              f"+/-{get_error_bound((5000 // step) ** 2):.2f}% (95% confidence)\n")
 
-    for file in files:
-        print("Checking file {file}\n")
+    cache = qa_cache.QACache(cache_file) if cache_file is not None else None
 
-        pixelqa = get_pixelqa(file)
+    summaries = {}
 
-        sensor = get_sensor(file)
+    if cache is not None:
+        for file in files:
+            summary = cache.get_summary(file, step=step)
 
-        if sensor == "L8":
-            pqa_vals = [322, 324]
+            if summary is not None:
+                summaries[file] = summary
 
-        else:
-            pqa_vals = [66, 68]
+        print(f"{len(summaries)} of {len(files)} scenes found in the cache {cache_file}\n")
 
-        cloud_cover = get_cloud_cover(pixelqa, pqa_vals)
+    start = time.time()
 
-        if cloud_cover <= cloud_threshold:
-            filtered.append(file)
+    results = list(scene_pool.run_scenes(check_scene, [f for f in files if f not in summaries], args=(step,),
+                                         workers=workers))
+
+    for file, summary, _, error in results:
+        if error is None:
+            summaries[file] = summary
+
+            if cache is not None:
+                cache.put_summary(file, summary)
+
+    # Percent of the scene covered by clouds, i.e. not clear
+    filtered = [file for file in files
+                if file in summaries and 100 - int(summaries[file]["clear_fraction"] * 100) <= cloud_threshold]
 
     write_to_txt(filtered, outdir)
 
+    scene_pool.summarize(results, elapsed=time.time() - start)
+
     return None
 
 
@@ -130,9 +162,19 @@ if __name__=="__main__":
     parser.add_argument("-o", dest="outdir", type=str, required=True,
                         help="The full path to the output directory where the cloud-filtered scene list will be saved")
 
-    parser.add_argument("-cc", dest="cloud_threshold", type=int, required=False, metavar="0 - 100",
+    parser.add_argument("-cc", dest="cloud_threshold", type=int, required=False, default=10, metavar="0 - 100",
                         help="The percent of maximum cloud cover a scene must have to be allowed through the filter")
 
+    parser.add_argument("-s", "--step", dest="step", type=int, required=False, default=1,
+                        help="Fast scan reading only every step-th PIXELQA pixel in each direction, default is 1 "
+                             "(exact)")
+
+    parser.add_argument("-n", "--workers", dest="workers", type=int, required=False, default=1,
+                        help="The number of scenes to check in parallel, default is 1")
+
+    parser.add_argument("--qa-cache", dest="cache_file", type=str, required=False, default=None,
+                        help="The full path to a QA summary cache file, created if it does not exist")
+
     args = parser.parse_args()
 
     main_work(**vars(args))
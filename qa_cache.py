@@ -0,0 +1,191 @@
+"""
+Persistent cache of per-scene PIXELQA summaries and point values, stored in a SQLite file.  Entries are
+keyed by the archive path together with its size and modification time, so an entry is ignored and
+replaced as soon as the archive changes.
+"""
+
+import io
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+import ard_tar
+import pixelqa
+
+# Approximate size of the stored PIXELQA thumbnail in each direction
+THUMBNAIL_SIZE = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS summary (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    step INTEGER,
+    sensor TEXT,
+    counts TEXT,
+    clear_fraction REAL,
+    fill_fraction REAL,
+    qa_values BLOB,
+    qa_counts BLOB,
+    thumbnail BLOB
+);
+CREATE TABLE IF NOT EXISTS points (
+    path TEXT,
+    size INTEGER,
+    mtime REAL,
+    row INTEGER,
+    col INTEGER,
+    value INTEGER,
+    PRIMARY KEY (path, row, col)
+);
+"""
+
+
+def to_blob(array):
+    """
+    :param array: <numpy.ndarray>
+    :return: <bytes>
+    """
+    buffer = io.BytesIO()
+
+    np.save(buffer, array, allow_pickle=False)
+
+    return buffer.getvalue()
+
+
+def from_blob(blob):
+    """
+    :param blob: <bytes>
+    :return: <numpy.ndarray>
+    """
+    return np.load(io.BytesIO(blob), allow_pickle=False)
+
+
+def summarize_qa(qa, sensor, step=1):
+    """
+    Summarize a PIXELQA band: the pixel count of each flag, the clear and fill fractions, the count of each
+    PIXELQA value, and a thumbnail
+    :param qa: <numpy.ndarray> PIXELQA
+    :param sensor: <str>
+    :param step: <int> The decimation factor qa was read with, 1 if every pixel was read
+    :return: <dict>
+    """
+    value_counts = pixelqa.count_values(qa)
+
+    counts = pixelqa.count_flags(qa, sensor, counts=value_counts)
+
+    qa_values = np.flatnonzero(value_counts)
+
+    thumb_step = max(1, max(qa.shape) // THUMBNAIL_SIZE)
+
+    return {"step": step,
+            "sensor": sensor,
+            "counts": counts,
+            "clear_fraction": counts["clear"] / counts["total"],
+            "fill_fraction": counts["fill"] / counts["total"],
+            "qa_values": qa_values,
+            "qa_counts": value_counts[qa_values],
+            "thumbnail": np.ascontiguousarray(qa[::thumb_step, ::thumb_step])}
+
+
+class QACache:
+    def __init__(self, path):
+        """
+
+        :param path: <str> The SQLite file, created if it does not exist
+        """
+        self.path = path
+
+        self.conn = sqlite3.connect(path, timeout=60)
+
+        self.conn.executescript(SCHEMA)
+
+    @staticmethod
+    def get_key(scene):
+        """
+        Return the archive path, size, and modification time identifying a cache entry
+        :param scene: <str> Archive path, with or without the /vsitar/ prefix
+        :return: <tuple>
+        """
+        tar_path = os.path.abspath(ard_tar.get_tar_path(scene))
+
+        stat = os.stat(tar_path)
+
+        return tar_path, stat.st_size, stat.st_mtime
+
+    def get_summary(self, scene, step=1):
+        """
+        Return the cached summary, or None if there is no current entry read at step or finer
+        :param scene: <str>
+        :param step: <int>
+        :return: <dict>
+        """
+        path, size, mtime = self.get_key(scene)
+
+        row = self.conn.execute("SELECT size, mtime, step, sensor, counts, clear_fraction, fill_fraction, "
+                                "qa_values, qa_counts, thumbnail FROM summary WHERE path = ?", (path,)).fetchone()
+
+        if row is None or row[0] != size or row[1] != mtime or row[2] > step:
+            return None
+
+        return {"step": row[2],
+                "sensor": row[3],
+                "counts": json.loads(row[4]),
+                "clear_fraction": row[5],
+                "fill_fraction": row[6],
+                "qa_values": from_blob(row[7]),
+                "qa_counts": from_blob(row[8]),
+                "thumbnail": from_blob(row[9])}
+
+    def put_summary(self, scene, summary):
+        """
+        Store a summary from summarize_qa
+        :param scene: <str>
+        :param summary: <dict>
+        :return:
+        """
+        path, size, mtime = self.get_key(scene)
+
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO summary VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              (path, size, mtime, summary["step"], summary["sensor"], json.dumps(summary["counts"]),
+                               summary["clear_fraction"], summary["fill_fraction"], to_blob(summary["qa_values"]),
+                               to_blob(summary["qa_counts"]), to_blob(summary["thumbnail"])))
+
+            # Point values of an archive that changed are out of date as well
+            self.conn.execute("DELETE FROM points WHERE path = ? AND (size != ? OR mtime != ?)", (path, size, mtime))
+
+        return None
+
+    def get_points(self, scene):
+        """
+        Return every cached PIXELQA value of a scene, with a single stat of the archive and a single query
+        :param scene: <str>
+        :return: <dict> (row, col) to value
+        """
+        path, size, mtime = self.get_key(scene)
+
+        rows = self.conn.execute("SELECT row, col, value FROM points WHERE path = ? AND size = ? AND mtime = ?",
+                                 (path, size, mtime)).fetchall()
+
+        return {(row, col): value for row, col, value in rows}
+
+    def put_points(self, scene, values):
+        """
+        Store PIXELQA values of a scene in a single transaction
+        :param scene: <str>
+        :param values: <dict> (row, col) to value
+        :return:
+        """
+        path, size, mtime = self.get_key(scene)
+
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?, ?)",
+                                  [(path, size, mtime, row, col, int(value)) for (row, col), value in values.items()])
+
+        return None
+
+    def close(self):
+        self.conn.close()
@@ -1,30 +1,102 @@
 
 import os
 import sys
+import time
 import numpy as np
 from argparse import ArgumentParser
-import subprocess
 from osgeo import gdal
 
+import ard_tar
+import histogram
+import manifest
+import pixelqa
+import scene_pool
+from tasseled_cap import MULTIBAND, TC_BANDS
 
-def make_raster(infile, outdir, array, tc_band):
+# Approximate statistics are calculated from a regular sample of about this many pixels
+APPROX_PIXELS = 1000000
+
+
+def set_stats(band, array, stats="exact", save_histogram=False, nodata=0):
+    """
+    Calculate the statistics of an unsigned 8-bit array already in memory and attach them to the band,
+    the same values gdalinfo -stats would calculate by reading the file back
+    :param band: <gdal.Band>
+    :param array: <numpy.ndarray> uint8
+    :param stats: <str> exact, approx, or none
+    :param save_histogram: <bool> Also attach the 256 bin histogram as the default histogram
+    :param nodata: <int> Value excluded from the statistics
+    :return:
+    """
+    if stats == "none":
+        return None
+
+    if stats == "approx":
+        step = max(1, int(np.sqrt(array.size / APPROX_PIXELS)))
+
+        array = array[::step, ::step]
+
+    counts = np.bincount(array.ravel(), minlength=256)
+
+    if nodata is not None:
+        counts[nodata] = 0
+
+    total = counts.sum()
+
+    if total == 0:
+        return None
+
+    values = np.arange(256, dtype=np.float64)
+
+    mean = np.dot(values, counts) / total
+
+    std = np.sqrt(np.dot((values - mean) ** 2, counts) / total)
+
+    valid = np.flatnonzero(counts)
+
+    band.SetStatistics(float(valid[0]), float(valid[-1]), float(mean), float(std))
+
+    if stats == "approx":
+        band.SetMetadataItem("STATISTICS_APPROXIMATE", "YES")
+
+    if save_histogram:
+        band.SetDefaultHistogram(-0.5, 255.5, counts.tolist())
+
+    return None
+
+
+def get_outfile(infile, outdir, tc_band):
+    """
+    Return the path make_raster writes a rescaled TC band to
+    :param infile: <str> The TC raster
+    :param outdir: <str>
+    :param tc_band: <str>
+    :return: <str>
+    """
+    # Outputs from a 3-band TC raster are split back into one file per TC band
+    basename = os.path.basename(infile).replace(f"_{MULTIBAND}", f"_{tc_band}")
+
+    return f"{outdir}{os.sep}{tc_band}{os.sep}{basename}"
+
+
+def make_raster(infile, outdir, array, tc_band, stats="exact", save_histogram=False):
     """
 
     :param infile:
     :param outdir:
     :param array:
     :param tc_band:
+    :param stats: <str> exact, approx, or none
+    :param save_histogram: <bool> Also save the histogram with the statistics
     :return:
     """
-    basename = os.path.basename(infile)
+    outfile = get_outfile(infile, outdir, tc_band)
 
-    subdir = f"{outdir}{os.sep}{tc_band}"
+    subdir = os.path.dirname(outfile)
 
-    if not os.path.exists(subdir):
+    if not subdir.startswith("/vsimem/") and not os.path.exists(subdir):
         os.makedirs(subdir)
 
-    outfile = f"{subdir}{os.sep}{basename}"
-
     src = gdal.Open(infile, gdal.GA_ReadOnly)
 
     if src is None:
@@ -47,15 +119,14 @@ def make_raster(infile, outdir, array, tc_band):
     out_band.WriteArray(array)
     out_band.SetNoDataValue(0)
 
+    set_stats(out_band, array, stats=stats, save_histogram=save_histogram)
+
     out_raster.SetProjection(src.GetProjection())
     out_raster.SetGeoTransform(src.GetGeoTransform())
 
     out_band = None
     out_raster = None
 
-    get_stats = f"gdalinfo -stats {outfile}"
-    subprocess.call(get_stats, shell=True)
-
     return None
 
 
@@ -90,29 +161,88 @@ def clip_array(array, qa, limits):
     return clipped
 
 
-def get_percentiles(array, qa, lower_percentile=12, upper_percentile=88):
+def clip_rescale(array, qa, limits, out_min=1.0, out_max=255.0, out=None, block_rows=100):
+    """
+    Clip to the limits, rescale, and cast to unsigned 8-bit in one pass over strips of rows, writing
+    directly into the output.  Gives the same values as clip_array followed by rescale_array without
+    their full size temporaries.  Pixels outside of qa are set to 0.
+    :param array: <numpy.ndarray>
+    :param qa: <numpy.ndarray> Boolean mask of the pixels to rescale
+    :param limits: <list> Lower and upper clip values
+    :param out_min:
+    :param out_max:
+    :param out: <numpy.ndarray> Optional preallocated uint8 output
+    :param block_rows: <int> The number of rows processed at a time
+    :return: <numpy.ndarray>
     """
+    lower, upper = int(limits[0]), int(limits[1])
+
+    if out is None:
+        out = np.empty(array.shape, dtype=np.uint8)
+
+    work = np.empty((min(block_rows, array.shape[0]),) + array.shape[1:], dtype=np.float64)
 
+    for yoff in range(0, array.shape[0], block_rows):
+        block = array[yoff:yoff + block_rows]
+
+        temp = work[:block.shape[0]]
+
+        np.copyto(temp, block)
+        np.clip(temp, lower, upper, out=temp)
+
+        temp -= lower
+        temp *= out_max - out_min
+
+        if upper > lower:
+            temp /= upper - lower
+
+        out_block = out[yoff:yoff + block_rows]
+
+        out_block.fill(0)
+
+        np.copyto(out_block, temp, casting="unsafe", where=qa[yoff:yoff + block_rows])
+
+    return out
+
+
+def get_percentiles(array, qa, lower_percentile=12, upper_percentile=88, hist=None):
+    """
+    Calculate both percentiles from an integer histogram of the masked values in one pass
     :param array:
     :param qa:
     :param lower_percentile:
     :param upper_percentile:
+    :param hist: <numpy.ndarray> Optional precomputed histogram, e.g. from the tasseled_cap.py sidecar
     :return:
     """
-    return [np.percentile(array[qa], lower_percentile), np.percentile(array[qa], upper_percentile)]
+    if hist is None:
+        hist = histogram.get_histogram(array, qa)
 
+    return histogram.get_percentiles(hist, [lower_percentile, upper_percentile])
 
-def get_data(infile):
+
+def get_sidecar(tc_file):
+    """
+    Return the histograms saved by tasseled_cap.py alongside a TC raster, or None if there are none
+    :param tc_file: <str>
+    :return: <dict>
+    """
+    base = os.path.splitext(os.path.basename(tc_file))[0].rsplit("_", 1)[0]
+
+    return histogram.read_sidecar(f"{os.path.dirname(tc_file)}{os.sep}{base}_hist.npz")
+
+
+def get_data(infile, band=1):
     """
 
     :param infile:
+    :param band: <int> The band number to read
     :return:
     """
     src = gdal.Open(infile, gdal.GA_ReadOnly)
 
     if not src is None:
-        array = src.GetRasterBand(1).ReadAsArray()
-        return array.astype(np.int32)
+        return src.GetRasterBand(band).ReadAsArray()
     else:
         print(f"Could not open file {infile}")
         sys.exit(1)
@@ -124,11 +254,11 @@ def get_masks(tarfile):
     :param tarfile:
     :return:
     """
-    basename = os.path.basename(tarfile)[:-7]
+    basename = os.path.basename(tarfile)
 
     sensor = basename[0] + basename[3]
 
-    qafile = f"{tarfile}{os.sep}{basename}_PIXELQA.tif"
+    qafile = ard_tar.get_band_path(tarfile, "PIXELQA")
 
     src = gdal.Open(qafile, gdal.GA_ReadOnly)
 
@@ -139,21 +269,7 @@ def get_masks(tarfile):
 
     src_data = src.GetRasterBand(1).ReadAsArray()
 
-    mask_clear = np.zeros_like(src_data, dtype=np.bool)
-
-    mask_fill = np.copy(mask_clear)
-
-    if sensor == "L8":
-        # PIXELQA 322, 324 are clear land/water obs. with low confidence cloud and low confidence cirrus
-        mask_clear[(src_data == 322) | (src_data == 324)] = True
-
-    else:
-        # PIXELQA 66, 68 are clear land/water obs. with low confidence cloud
-        mask_clear[(src_data == 66) | (src_data == 68)] = True
-
-    mask_fill[src_data != 1] = True
-
-    return mask_clear, mask_fill
+    return pixelqa.get_masks(src_data, sensor)
 
 
 def get_tarlist(tarfiles):
@@ -173,11 +289,12 @@ def get_tarlist(tarfiles):
     return sorted(tarlist)
 
 
-def get_files(in_dir, lookfor):
+def get_files(in_dir, lookfor, required=True):
     """
 
     :param in_dir: <str>
     :param lookfor: <str>
+    :param required: <bool> Exit if no files are found
     :return file_list: <str[]>
     """
     file_list = []
@@ -186,67 +303,124 @@ def get_files(in_dir, lookfor):
             if lookfor in file and file[-4:] == ".tif":
                 file_list.append(os.path.join(root, file))
 
-    if len(file_list) == 0:
+    if len(file_list) == 0 and required:
         print(f"Could not find any files in {in_dir}")
         sys.exit(1)
 
     return sorted(file_list)
 
 
-def main_work(tc_dir, file_list, output_dir):
+def rescale_scene(scene, output_dir, stats="exact", save_histogram=False):
+    """
+    Rescale the three TC bands of one scene.  The PIXELQA is read and masked once and the masks are
+    shared by all three bands.
+    :param scene: <tuple> The scene's archive and a dict of TC band name to (file, band number)
+    :param output_dir: <str>
+    :param stats: <str> exact, approx, or none
+    :param save_histogram: <bool> Also save the histogram with the statistics
+    :return:
+    """
+    tarfile, tc_files = scene
+
+    qa_clear, qa_fill = get_masks(tarfile)
+
+    use_clear = bool(np.any(qa_clear))
+
+    if not use_clear:
+        print(f"PIXELQA has no clear pixels in scene {tarfile}, "
+              f"using the QA_Fill mask instead to retrieve percentiles")
+
+    hists = None
+
+    # Output buffer reused for each TC band
+    rescaled_data = np.empty(qa_fill.shape, dtype=np.uint8)
+
+    for key, (file, band) in tc_files.items():
+        print(f"Working on file {file}\n")
+
+        array = get_data(infile=file, band=band)
+
+        if hists is None:
+            hists = get_sidecar(file) or {}
+
+        if use_clear:
+            limits = get_percentiles(array=array, qa=qa_clear, hist=hists.get(f"{key}_clear"))
+
+        else:
+            limits = get_percentiles(array=array, qa=qa_fill, hist=hists.get(f"{key}_fill"))
+
+        clip_rescale(array=array, qa=qa_fill, limits=limits, out=rescaled_data)
+
+        # Use this if rescaling without the percent clip
+        # rescaled_data = rescale_array(array=array, qa=qa_fill)
+
+        make_raster(file, output_dir, rescaled_data, key, stats=stats, save_histogram=save_histogram)
+
+    return None
+
+
+def main_work(tc_dir, file_list, output_dir, stats="exact", save_histogram=False, workers=1, cache_mb=None,
+              manifest_file=None):
     """
 
     :param tc_dir:
     :param output_dir:
     :param file_list:
+    :param stats: <str> exact, approx, or none
+    :param save_histogram: <bool> Also save the histogram with the statistics
+    :param workers: <int> The number of scenes to process in parallel
+    :param cache_mb: <int> The GDAL cache size in megabytes for each worker
+    :param manifest_file: <str> Optional run manifest, scenes it records as done are skipped
     :return:
     """
     lookup_files = {}
 
-    b_files = get_files(tc_dir, lookfor="brightness")
-    lookup_files["brightness"] = b_files
+    # Lists of (file, band number), using the 3-band TC rasters if tasseled_cap.py wrote them
+    multiband_files = get_files(tc_dir, lookfor=f"_{MULTIBAND}", required=False)
 
-    g_files = get_files(tc_dir, lookfor="greenness")
-    lookup_files["greenness"] = g_files
+    for band, key in enumerate(TC_BANDS, start=1):
+        if len(multiband_files) > 0:
+            lookup_files[key] = [(file, band) for file in multiband_files]
 
-    w_files = get_files(tc_dir, lookfor="wetness")
-    lookup_files["wetness"] = w_files
+        else:
+            lookup_files[key] = [(file, 1) for file in get_files(tc_dir, lookfor=key)]
 
     tarlist = get_tarlist(file_list)
 
-    for key in lookup_files.keys():
-        for ind, file in enumerate(lookup_files[key]):
-            test_date_file = os.path.splitext(os.path.basename(file))[0][15:23]
+    scenes = []
 
-            test_date_qa = os.path.splitext(os.path.basename(tarlist[ind]))[0][15:23]
+    for ind, tarfile in enumerate(tarlist):
+        test_date_qa = os.path.splitext(os.path.basename(tarfile))[0][15:23]
 
-            if not test_date_file == test_date_qa:
-                print("There is an inconsistency between the file lists")
-                sys.exit(1)
+        tc_files = {}
 
-            print(f"Working on file {file}\n")
+        for key in lookup_files.keys():
+            file, band = lookup_files[key][ind]
 
-            qa_clear, qa_fill = get_masks(tarlist[ind])
+            test_date_file = os.path.splitext(os.path.basename(file))[0][15:23]
 
-            array = get_data(infile=file)
+            if not test_date_file == test_date_qa:
+                print("There is an inconsistency between the file lists")
+                sys.exit(1)
 
-            if not np.any(qa_clear is True):
-                print(f"PIXELQA has no clear pixels in scene {file}, "
-                      f"using the QA_Fill mask instead to retrieve percentiles")
+            tc_files[key] = (file, band)
 
-                limits = get_percentiles(array=array, qa=qa_fill)
+        scenes.append((tarfile, tc_files))
 
-            else:
-                limits = get_percentiles(array=array, qa=qa_clear)
+    # The scene's percentiles come from its PIXELQA as well as its TC bands
+    tasks = ((tarfile, [ard_tar.get_tar_path(tarfile)] + sorted(set(file for file, _ in tc_files.values())),
+              [get_outfile(file, output_dir, key) for key, (file, _) in tc_files.items()], (tarfile, tc_files))
+             for tarfile, tc_files in scenes)
 
-            clipped_array = clip_array(array=array, qa=qa_fill, limits=limits)
+    run_manifest = manifest.Manifest(manifest_file) if manifest_file is not None else None
 
-            rescaled_data = rescale_array(array=clipped_array, qa=qa_fill)
+    start = time.time()
 
-            # Use this if rescaling without the percent clip
-            # rescaled_data = rescale_array(array=array, qa=qa_fill)
+    results = list(manifest.run_stage(run_manifest, "rescale", tasks, {"stats": stats, "histogram": save_histogram},
+                                      rescale_scene, args=(output_dir, stats, save_histogram), workers=workers,
+                                      cache_mb=cache_mb))
 
-            make_raster(file, output_dir, rescaled_data, key)
+    scene_pool.summarize(results, elapsed=time.time() - start)
 
     return None
 
@@ -263,6 +437,23 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--output", dest="output_dir", type=str, required=True,
                         help="The full path to the output root directory")
 
+    parser.add_argument("-s", "--stats", dest="stats", type=str, required=False, default="exact",
+                        choices=["exact", "approx", "none"],
+                        help="How the statistics of the output rasters are calculated, default is exact")
+
+    parser.add_argument("--histogram", dest="save_histogram", action="store_true",
+                        help="Also save a histogram with the statistics of the output rasters")
+
+    parser.add_argument("-n", "--workers", dest="workers", type=int, required=False, default=1,
+                        help="The number of scenes to process in parallel, default is 1")
+
+    parser.add_argument("-c", "--cache", dest="cache_mb", type=int, required=False, default=None,
+                        help="The GDAL cache size in MB for each worker")
+
+    parser.add_argument("--manifest", dest="manifest_file", type=str, required=False, default=None,
+                        help="The full path to a run manifest, created if it does not exist, scenes it records as "
+                             "done are skipped")
+
     args = parser.parse_args()
 
     main_work(**vars(args))
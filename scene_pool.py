@@ -0,0 +1,322 @@
+"""
+Run a function over many scenes with a pool of worker processes, keeping every worker busy and recording
+the time taken and any failure for each one.  Results are collected as the scenes finish, so a slow scene
+never holds up the others.  Failed scenes can be retried, a worker process that dies is replaced and its
+scenes are run again, and worker processes can be replaced after a number of scenes so one that leaks
+memory does not slow the rest of the run.
+"""
+
+import heapq
+import itertools
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from osgeo import gdal
+
+LOST = "BrokenProcessPool: the worker process died while running this scene"
+
+
+def init_worker(cache_mb=None):
+    """
+    Set the GDAL block cache size for this process
+    :param cache_mb: <int> Cache size in megabytes, or None to keep the GDAL default
+    :return:
+    """
+    if cache_mb is not None:
+        gdal.SetCacheMax(cache_mb * 1024 * 1024)
+
+    return None
+
+
+def run_scene(func, scene, args=()):
+    """
+    Call func(scene, *args), catching any failure so one bad scene does not stop the run
+    :param func: <function>
+    :param scene: <str>
+    :param args: <tuple>
+    :return: <tuple> (scene, result, seconds, error message or None)
+    """
+    start = time.time()
+
+    try:
+        result, error = func(scene, *args), None
+
+    except (Exception, SystemExit) as e:
+        result, error = None, f"{type(e).__name__}: {e}"
+
+    return scene, result, time.time() - start, error
+
+
+def get_delay(backoff, attempt):
+    """
+    :param backoff: <float> Seconds to wait before the first retry
+    :param attempt: <int> The number of attempts so far
+    :return: <float> Seconds to wait before the next attempt, doubled for each further retry
+    """
+    return backoff * 2 ** (attempt - 1)
+
+
+def add_attempts(error, attempts):
+    """
+    :param error: <str>
+    :param attempts: <int>
+    :return: <str>
+    """
+    return error if attempts == 1 else f"{error} (after {attempts} attempts)"
+
+
+def make_pool(workers, cache_mb=None, maxtasksperchild=None):
+    """
+    :param workers: <int>
+    :param cache_mb: <int>
+    :param maxtasksperchild: <int> Replace each worker process after this many scenes, None keeps them.
+                             Python starts these workers with spawn rather than fork.  Needs Python 3.11,
+                             on older versions the workers are kept.
+    :return: <concurrent.futures.ProcessPoolExecutor>
+    """
+    kwargs = {}
+
+    if maxtasksperchild is not None:
+        if sys.version_info >= (3, 11):
+            kwargs["max_tasks_per_child"] = maxtasksperchild
+
+        else:
+            print("Replacing worker processes needs Python 3.11 or later, keeping them for the whole run")
+
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cache_mb,), **kwargs)
+
+
+def stop_pool(pool):
+    """
+    Stop the worker processes without waiting for the scenes they are running.  The executor can not
+    cancel a running call, so its processes are terminated directly.
+    :param pool: <concurrent.futures.ProcessPoolExecutor>
+    :return:
+    """
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+
+    # Scenes still queued fail with the broken pool
+    pool.shutdown(wait=True)
+
+    return None
+
+
+def run_serial(func, scenes, args=(), cache_mb=None, retries=0, backoff=1.0):
+    """
+    run_scenes in this process, waiting between the attempts of a failed scene
+    :return: <generator>
+    """
+    init_worker(cache_mb)
+
+    for scene in scenes:
+        seconds = 0.0
+
+        for attempt in range(1, retries + 2):
+            if attempt > 1:
+                time.sleep(get_delay(backoff, attempt - 1))
+
+            _, result, attempt_seconds, error = run_scene(func, scene, args)
+
+            seconds += attempt_seconds
+
+            if error is None:
+                break
+
+        yield scene, result, seconds, error if error is None else add_attempts(error, attempt)
+
+
+def run_scenes(func, scenes, args=(), workers=1, cache_mb=None, max_pending=None, retries=0, backoff=1.0,
+               maxtasksperchild=None, timeout=None):
+    """
+    Generate (scene, result, seconds, error) for each scene.  With more than one worker the scenes are
+    sent to a process pool, keeping at most max_pending scenes in flight, and results are generated in
+    the order the scenes finish.  scenes is only read as work is submitted, so a generator, e.g. a
+    directory walk, keeps all of the workers busy while it is still running.
+
+    A failed scene is put back in the queue to run again once its backoff has passed, while the workers
+    go on with other scenes.  If a worker process dies, e.g. from a segfault or the OOM killer, the pool
+    can not tell which scene it was running, so a new pool is started and every scene that was in flight
+    is run again by itself; only a scene that kills its worker while running alone counts as failed.  A
+    scene running for longer than timeout fails with a TimeoutError, and the pool is restarted in the same
+    way to stop it.
+    :param func: <function> Must be defined at module level so it can be sent to the workers
+    :param scenes: <iterable> Scene paths, or tuples whose first item is the scene path
+    :param args: <tuple> Additional arguments passed to func after the scene
+    :param workers: <int>
+    :param cache_mb: <int> GDAL cache size for each worker in megabytes
+    :param max_pending: <int> Defaults to the number of workers
+    :param retries: <int> The number of times to try a failed scene again
+    :param backoff: <float> Seconds to wait before the first retry, doubled before each further retry
+    :param maxtasksperchild: <int> Replace each worker process after this many scenes, None keeps them
+    :param timeout: <float> Seconds a scene may run, None waits indefinitely
+    :return: <generator> The scene in each result is the object taken from scenes
+    """
+    if workers <= 1:
+        yield from run_serial(func, scenes, args, cache_mb, retries, backoff)
+        return
+
+    if max_pending is None:
+        max_pending = workers
+
+    scenes = iter(scenes)
+
+    # Future to (scene, attempts, start time, seconds of earlier attempts, run alone)
+    pending = {}
+
+    # Scenes waiting to run again as (ready time, order, scene, attempts so far, seconds so far, run alone)
+    retry_queue = []
+
+    order = itertools.count()
+
+    pool = make_pool(workers, cache_mb, maxtasksperchild)
+
+    def submit(scene, attempt, seconds, alone=False):
+        future = pool.submit(run_scene, func, scene, args)
+        pending[future] = (scene, attempt, time.monotonic(), seconds, alone)
+
+    def requeue(scene, attempt, seconds, ready, alone=False):
+        heapq.heappush(retry_queue, (ready, next(order), scene, attempt, seconds, alone))
+
+    def finish(scene, attempt, seconds, result, error):
+        if error is not None and attempt <= retries:
+            requeue(scene, attempt, seconds, time.monotonic() + get_delay(backoff, attempt))
+            return None
+
+        return scene, result, seconds, error if error is None else add_attempts(error, attempt)
+
+    try:
+        exhausted = False
+
+        while True:
+            now = time.monotonic()
+
+            # A scene suspected of killing its worker runs by itself, so nothing else is submitted with it
+            while len(pending) < max_pending and not any(entry[4] for entry in pending.values()):
+                if len(retry_queue) > 0 and retry_queue[0][0] <= now:
+                    if retry_queue[0][5] and len(pending) > 0:
+                        break
+
+                    _, _, scene, attempt, seconds, alone = heapq.heappop(retry_queue)
+                    submit(scene, attempt + 1, seconds, alone)
+
+                elif not exhausted:
+                    scene = next(scenes, None)
+
+                    if scene is None:
+                        exhausted = True
+                    else:
+                        submit(scene, 1, 0.0)
+
+                else:
+                    break
+
+            if len(pending) == 0:
+                if len(retry_queue) == 0:
+                    break
+
+                time.sleep(max(0.0, retry_queue[0][0] - now))
+                continue
+
+            # Wake for the next retry that is due or the next scene to reach its timeout
+            deadlines = [retry_queue[0][0]] if len(retry_queue) > 0 else []
+
+            if timeout is not None:
+                deadlines += [entry[2] + timeout for entry in pending.values()]
+
+            wait_time = max(0.0, min(deadlines) - now) if len(deadlines) > 0 else None
+
+            done, _ = wait(list(pending), timeout=wait_time, return_when=FIRST_COMPLETED)
+
+            broken = False
+
+            for future in done:
+                scene, attempt, start, seconds, alone = pending.pop(future)
+
+                try:
+                    _, result, attempt_seconds, error = future.result()
+
+                except BrokenProcessPool:
+                    broken = True
+
+                    if not alone:
+                        # Any of the scenes in flight may have killed the worker, so each runs again alone
+                        requeue(scene, attempt - 1, seconds, time.monotonic(), alone=True)
+                        continue
+
+                    result, attempt_seconds, error = None, time.monotonic() - start, LOST
+
+                output = finish(scene, attempt, seconds + attempt_seconds, result, error)
+
+                if output is not None:
+                    yield output
+
+            now = time.monotonic()
+
+            expired = [future for future, entry in pending.items() if timeout is not None and now - entry[2] >= timeout]
+
+            if len(expired) > 0 or broken:
+                # Stop the hung or broken pool and run what was still in flight in a new one
+                stop_pool(pool)
+
+                pool = make_pool(workers, cache_mb, maxtasksperchild)
+
+                for future, (scene, attempt, start, seconds, alone) in list(pending.items()):
+                    del pending[future]
+
+                    if future in expired:
+                        output = finish(scene, attempt, seconds + now - start, None,
+                                        f"TimeoutError: no result after {timeout}s")
+
+                        if output is not None:
+                            yield output
+
+                    else:
+                        # Stopped through no fault of its own, so the attempt does not count
+                        requeue(scene, attempt - 1, seconds, now, alone=alone or broken)
+
+        pool.shutdown(wait=True)
+
+    except BaseException:
+        # Interrupted, or the caller stopped reading the results
+        stop_pool(pool)
+        raise
+
+
+def get_name(scene):
+    """
+    Return the scene path of a scene given to run_scenes
+    :param scene: <str or tuple>
+    :return: <str>
+    """
+    return scene[0] if isinstance(scene, tuple) else scene
+
+
+def summarize(results, elapsed=None):
+    """
+    Print the time taken for each scene followed by totals and a list of failures
+    :param results: <list> Tuples generated by run_scenes
+    :param elapsed: <float> Wall clock seconds for the whole run
+    :return:
+    """
+    failures = [(scene, error) for scene, _, _, error in results if error is not None]
+
+    for scene, _, seconds, error in results:
+        status = "FAILED" if error is not None else "ok"
+        print(f"{seconds:8.1f}s  {status:6}  {get_name(scene)}")
+
+    times = [seconds for _, _, seconds, _ in results]
+
+    if len(times) > 0:
+        print(f"\n{len(results)} scenes, {len(failures)} failed, mean {sum(times) / len(times):.1f}s, "
+              f"max {max(times):.1f}s per scene")
+
+    if elapsed is not None:
+        print(f"Total elapsed time {elapsed:.1f}s")
+
+    for scene, error in failures:
+        print(f"Failed: {get_name(scene)}\n    {error}")
+
+    return None
@@ -3,20 +3,23 @@ Stack files directly from the ARD .tar archives
 Built from Kelcy Smith's espa_to_envi_c01b.py script.
 Works for TA or SR.
 
+The band members are read in place through GDAL's /vsitar/ file system and stacked in-process with
+gdal.BuildVRT and gdal.Translate, so nothing is extracted and no GDAL command line tools are spawned.
+
 Date: 11/3/2017
 """
 
 import os
-import subprocess
-import multiprocessing as mp
-import tarfile
-import shutil
 import logging
 import sys
+import time
 import argparse
 
 from osgeo import gdal
 
+import manifest
+import scene_pool
+
 
 # TODO add option to select TA, SR, BT, QA
 
@@ -28,40 +31,75 @@ LOGGER.addHandler(handler)
 LOGGER.setLevel(logging.INFO)
 
 
-def create_tiles(inpath, outpath, worker_num, work_dir, product):
+# The VRT of each scene is only kept in memory
+VSIMEM = '/vsimem'
+
+
+def create_tiles(inpath, outpath, worker_num, product, work_dir=None, options=None, retries=2, backoff=5.0,
+                 maxtasksperchild=50, manifest_file=None, timeout=None):
+    """Stack every archive under inpath with a pool of worker_num processes, skipping archives the
+    optional run manifest records as done"""
     if not os.path.exists(outpath):
         os.makedirs(outpath)
 
-    file_q = mp.Queue()
-    message_q = mp.Queue()
+    start = time.time()
+
+    results = []
+
+    tasks = ((file, [file], [get_outfile(file, outpath, product)], file) for file in file_enqueue(inpath, product))
+
+    run_manifest = manifest.Manifest(manifest_file) if manifest_file is not None else None
 
-    file_enqueue(inpath, file_q, worker_num, product)
-    work = work_paths(worker_num, work_dir)
+    # Archives are submitted as the directory walk finds them
+    for result in manifest.run_stage(run_manifest, 'stack_ard_source', tasks, {'options': options}, stack_scene,
+                                     args=(outpath, product, options), workers=worker_num, retries=retries,
+                                     backoff=backoff, maxtasksperchild=maxtasksperchild, timeout=timeout):
+        file, _, seconds, error = result
 
-    message = mp.Process(target=progress, args=(message_q, worker_num))
-    message.start()
-    for i in range(worker_num - 1):
-        print(work[i])
-        p_args = (file_q, message_q, outpath, work[i], product)
-        print(p_args)
-        mp.Process(target=process_tile, args=p_args).start()
+        if error is None:
+            LOGGER.info('Stacked %s in %.1fs' % (file, seconds))
+        else:
+            LOGGER.error('Failed %s: %s' % (file, error))
 
-    message.join()
+        results.append(result)
 
+    scene_pool.summarize(results, elapsed=time.time() - start)
 
-def unpackage(file, work_path):
-    with tarfile.open(file) as f:
-        f.extractall(path=work_path)
+    failures = [result for result in results if result[3] is not None]
 
+    return len(failures)
 
-def translate(pathing):
-    subprocess.call('gdal_translate -of GTiff {} {}'
-                    .format(pathing['TRAN']['IN'], pathing['TRAN']['OUT']), shell=True)
+
+def translate(pathing, options=None):
+    """Write the stack, to a temporary name first so an interrupted write is never taken as finished"""
+    temp = pathing['TRAN']['OUT'] + '.part'
+
+    ds = gdal.Translate(temp, pathing['TRAN']['IN'], format='GTiff', creationOptions=options or [])
+
+    if ds is None:
+        raise IOError('Could not write {}'.format(pathing['TRAN']['OUT']))
+
+    ds = None
+
+    os.replace(temp, pathing['TRAN']['OUT'])
 
 
 def vrt(pathing):
-    subprocess.call('gdalbuildvrt -separate {} {}'
-                    .format(pathing['VRT']['OUT'], pathing['VRT']['IN']), shell=True)
+    ds = gdal.BuildVRT(pathing['VRT']['OUT'], pathing['VRT']['IN'], separate=True)
+
+    # BuildVRT leaves out any band it can not open
+    if ds is None or ds.RasterCount != len(pathing['VRT']['IN']):
+        raise IOError('Could not build {} from all of {}'.format(pathing['VRT']['OUT'], pathing['VRT']['IN']))
+
+    # Closing the dataset writes the VRT
+    ds = None
+
+
+def get_outfile(file, out_path, prod):
+    """The stack written for an archive"""
+    tiff_base = base_name(file)
+
+    return os.path.join(out_path, tiff_base, tiff_base + f'_{prod}stack.tif')
 
 
 def build_paths(out_path, tiff_base, work_path, band_list, prod):
@@ -70,10 +108,10 @@ def build_paths(out_path, tiff_base, work_path, band_list, prod):
     if not os.path.exists(base):
         os.makedirs(base)
 
-    phs = {'VRT': {'OUT': os.path.join(work_path, tiff_base + '.vrt'),
-                   'IN': ' '.join(band_list)},
-           'TRAN': {'IN': os.path.join(work_path, tiff_base + '.vrt'),
-                    'OUT': os.path.join(base, tiff_base + f'_{prod}stack.tif')}}
+    phs = {'VRT': {'OUT': '{}/{}.vrt'.format(VSIMEM, tiff_base),
+                   'IN': band_list},
+           'TRAN': {'IN': '{}/{}.vrt'.format(VSIMEM, tiff_base),
+                    'OUT': get_outfile(tiff_base, out_path, prod)}}
 
     return phs
 
@@ -98,124 +136,56 @@ def build_tm_list(work_path, tiff_base, prod):
             '{}_PIXELQA.tif'.format(os.path.join(work_path, tiff_base))]
 
 
-def base_name(work_path, prod):
-    base = ''
-    for tiff_file in os.listdir(work_path):
-        if tiff_file[-9:] != f'_{prod}B2.tif':
-            continue
-
-        base = tiff_file[:-9]
-        break
-
-    return base
+def base_name(file):
+    """The entity id, e.g. LC08_CU_003010_20150101_20170101_C01_V01, from the archive name"""
+    return os.path.basename(file)[:40]
 
 
-def clean_up(work_path):
-    for f in os.listdir(work_path):
-        os.remove(os.path.join(work_path, f))
+def stack_scene(file, out_path, prod, options=None):
+    """Stack the band members of an archive, returning the output path"""
+    tiff_base = base_name(file)
 
+    # The band lists join each member name to the archive path within /vsitar/
+    work_path = '/vsitar/{}'.format(file)
 
-def find_tile_name(file):
-    ds = gdal.Open(file)
-
-    affine = extent_to_hv(ds.GetGeoTransform())
+    if tiff_base[3] == '8':
+        band_list = build_l8_list(work_path, tiff_base, prod)
+    else:
+        band_list = build_tm_list(work_path, tiff_base, prod)
 
-    ds = None
-
-    return affine
+    pathing = build_paths(out_path, tiff_base, work_path, band_list, prod)
 
+    if os.path.exists(pathing['TRAN']['OUT']):
+        return pathing['TRAN']['OUT']
 
-def process_tile(file_q, prog_q, out_path, work_path, prod):
-    """Process a file from the queue"""
-    proc = work_path[-1]
-    print(proc)
+    try:
+        vrt(pathing)
 
-    while True:
-        try:
-            file = file_q.get()
-            print(file)
-            if file == 'KILL':
-                prog_q.put('Killing process %s' % proc)
-                break
+        translate(pathing, options)
 
-            # srpath, btpath = file
+    finally:
+        gdal.Unlink(pathing['VRT']['OUT'])
 
+    return pathing['TRAN']['OUT']
 
-            prog_q.put('Process %s: Unpacking %s' % (proc, file))
-            unpackage(file, work_path)
 
+def find_tile_name(file):
+    ds = gdal.Open(file)
 
-            tiff_base = base_name(work_path, prod)
-            print(tiff_base)
-
-            if tiff_base[3] == '8':
-                band_list = build_l8_list(work_path, tiff_base, prod)
-            else:
-                band_list = build_tm_list(work_path, tiff_base, prod)
-
-            pathing = build_paths(out_path, tiff_base, work_path, band_list, prod)
-
-            print(pathing)
-
-            if os.path.exists(pathing['TRAN']['OUT']):
-                clean_up(work_path)
-                continue
-
-            prog_q.put('Process %s: Building VRT stack for %s' % (proc, tiff_base))
-            vrt(pathing)
-
-            prog_q.put('Process %s: Calling Translate for %s' % (proc, tiff_base))
-            translate(pathing)
+    affine = extent_to_hv(ds.GetGeoTransform())
 
-            clean_up(work_path)
-        except Exception as e:
-            prog_q.put('Process %s: Hit an exception - %s' % (proc, e))
-            prog_q.put('Killing process %s' % proc)
-            clean_up(work_path)
-            break
+    ds = None
 
-    os.rmdir(work_path)
+    return affine
 
 
-def file_enqueue(path, q, worker_num, prod):
-    """Builds a queue of files to be processed"""
+def file_enqueue(path, prod):
+    """Generates the files to be processed while walking the directory tree"""
 
     for root, dirs, files in os.walk(path):
         for file in files:
             if file[-6:] == f'{prod}.tar':
-
-                a = os.path.join(root, file)
-                print(a)
-                q.put(a)
-
-    for _ in range(worker_num):
-        q.put('KILL')
-
-
-def work_paths(worker_num, path):
-    """Makes working directories for the multi-processing"""
-
-    out = []
-    for i in range(worker_num - 1):
-        new_path = os.path.join(path, 'espa_ard_working%s' % i)
-        out.append(new_path)
-        if not os.path.exists(new_path):
-            os.makedirs(new_path)
-
-    return out
-
-
-def progress(prog_q, worker_num):
-    count = 0
-    while True:
-        message = prog_q.get()
-
-        LOGGER.info(message)
-
-        if message[:4] == 'Kill':
-            count += 1
-        if count >= worker_num - 1:
-            break
+                yield os.path.join(root, file)
 
 
 def extent_to_hv(geoaffine):
@@ -245,9 +215,32 @@ if __name__ == '__main__':
     parser.add_argument("-n", "--workers", dest="worker_num", type=int, required=False, default=20,
                         help="The number of consecutive processes, default is 20")
 
-    parser.add_argument("-w", "--workingdir", dest="work_dir", required=True,
-                        help="The full path to the working directory")
+    parser.add_argument("-r", "--retries", dest="retries", type=int, required=False, default=2,
+                        help="The number of times to retry a failed archive, default is 2")
+
+    parser.add_argument("--backoff", dest="backoff", type=float, required=False, default=5.0,
+                        help="Seconds to wait before the first retry, doubled for each further retry, default is 5")
+
+    parser.add_argument("--maxtasks", dest="maxtasksperchild", type=int, required=False, default=50,
+                        help="Replace each worker process after this many archives, default is 50.  Setting it "
+                             "starts the workers with spawn instead of fork, and needs Python 3.11 or later")
+
+    parser.add_argument("--timeout", dest="timeout", type=float, required=False, default=None,
+                        help="Fail an archive that takes longer than this many seconds, by default there is no limit. "
+                             "A worker process that dies is detected either way")
+
+    parser.add_argument("-w", "--workingdir", dest="work_dir", required=False, default=None,
+                        help="No longer used, the archives are read in place without a working directory")
+
+    parser.add_argument("-co", "--creation-option", dest="options", action="append", required=False, default=None,
+                        metavar="NAME=VALUE",
+                        help="A GeoTIFF creation option, e.g. -co TILED=YES -co COMPRESS=DEFLATE.  Leave the stacks "
+                             "uncompressed and untiled for memory mapped reading in tasseled_cap.py -s")
+
+    parser.add_argument("--manifest", dest="manifest_file", type=str, required=False, default=None,
+                        help="The full path to a run manifest, created if it does not exist, archives it records as "
+                             "done are skipped")
 
     args = parser.parse_args()
 
-    create_tiles(**vars(args))
+    sys.exit(1 if create_tiles(**vars(args)) > 0 else 0)
@@ -9,50 +9,156 @@ Date: 10/18/2017
 
 import os
 import sys
+import time
 
 import numpy as np
 from osgeo import gdal
 
-import get_scenes
+import ard_tar
+import histogram
+import manifest
+import memmap_stack
+import pixelqa
+import scene_pool
 import tc_bgw_coeffs
+import tc_cube
+import tc_numba
 
+TC_BANDS = ["brightness", "greenness", "wetness"]
 
-def get_raster(data, src, tc_band, out_dir, band="TAB1", ext=".tif"):
+# Name used in place of the TC band name for the single 3-band output
+MULTIBAND = "bgw"
+
+# The fixed-point coefficients are scaled by 2 ** FIXED_SHIFT.  Accumulating 6 Int16 reflectance values of
+# magnitude up to 20000 (saturation) stays within int32, and the coefficient rounding error of every sensor
+# is less than 1 DN for reflectance within the valid range -2000 to 16000
+FIXED_SHIFT = 15
+
+
+def get_outfile(src, tc_band, out_dir, ext=".tif"):
     """
-    Create raster from the input numpy array
-    :param data:
-    :param src:
-    :param tc_band:
-    :return:
+    Return the output file path for a TC band, creating the scene's output folder if needed
+    :param src: <str>
+    :param tc_band: <str>
+    :param out_dir: <str>
+    :param ext: <str>
+    :return: <str>
     """
-    src_file = f"{src}{os.sep}{os.path.basename(src)[:-7]}_{band}{ext}"
+    entity_id = ard_tar.get_entity_id(src)
 
-    out_folder = f"{out_dir}{os.sep}{os.path.basename(src)[:-7]}"
+    out_folder = f"{out_dir}{os.sep}{entity_id}"
 
-    if not os.path.exists(out_folder):
+    # GDAL's in-memory /vsimem/ file system has no folders to create
+    if not out_folder.startswith("/vsimem/") and not os.path.exists(out_folder):
         os.makedirs(out_folder)
 
-    out_file = f"{out_folder}{os.sep}{os.path.basename(src)[:-7]}_{tc_band}{ext}"
+    return f"{out_folder}{os.sep}{entity_id}_{tc_band}{ext}"
 
-    if not os.path.exists(out_file):
-        ref = gdal.Open(src_file, gdal.GA_ReadOnly)
 
-        rows = ref.RasterYSize
-        cols = ref.RasterXSize
+def get_creation_options(compress="NONE", predictor=None, tiled=True, bigtiff=False):
+    """
+    Build a list of GeoTIFF creation options
+    :param compress: <str> NONE, DEFLATE, ZSTD, or LZW
+    :param predictor: <int> 1 (none) or 2 (horizontal differencing)
+    :param tiled: <bool>
+    :param bigtiff: <bool>
+    :return: <list>
+    """
+    options = ["INTERLEAVE=BAND", f"COMPRESS={compress}"]
 
-        driver = ref.GetDriver()
+    if tiled:
+        options += ["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256"]
 
-        out_raster = driver.Create(out_file, cols, rows, 1, gdal.GDT_Int16)
+    if predictor is not None and compress != "NONE":
+        options.append(f"PREDICTOR={predictor}")
 
-        out_band = out_raster.GetRasterBand(1)
-        out_band.WriteArray(data, 0, 0)
+    if bigtiff:
+        options.append("BIGTIFF=YES")
 
-        out_raster.SetGeoTransform(ref.GetGeoTransform())
-        out_raster.SetProjection(ref.GetProjection())
+    return options
 
-        ref, out_raster = None, None
 
-    return None
+def get_outputs(scene, out_dir, multiband=False, hist=False, cube_only=False):
+    """
+    Return the paths of every file calculate_tc writes for a scene
+    :param scene: <str>
+    :param out_dir: <str>
+    :param multiband: <bool>
+    :param hist: <bool>
+    :param cube_only: <bool>
+    :return: <list>
+    """
+    outputs = []
+
+    if not cube_only:
+        outputs += [get_outfile(src=scene, tc_band=key, out_dir=out_dir) for key in
+                    ([MULTIBAND] if multiband else TC_BANDS)]
+
+    if hist:
+        outputs.append(get_outfile(src=scene, tc_band="hist", out_dir=out_dir, ext=".npz"))
+
+    return outputs
+
+
+def create_raster(ref, out_file, nbands=1, options=None):
+    """
+    Create an empty Int16 GeoTIFF matching the size and georeferencing of the reference dataset
+    :param ref: <gdal.Dataset>
+    :param out_file: <str>
+    :param nbands: <int>
+    :param options: <list> GeoTIFF creation options, the driver defaults are used if None
+    :return: <gdal.Dataset>
+    """
+    driver = gdal.GetDriverByName("GTiff")
+
+    out_raster = driver.Create(out_file, ref.RasterXSize, ref.RasterYSize, nbands, gdal.GDT_Int16,
+                               options=options or [])
+
+    if out_raster is None:
+        raise IOError(f"Could not create raster {out_file}")
+
+    out_raster.SetGeoTransform(ref.GetGeoTransform())
+    out_raster.SetProjection(ref.GetProjection())
+
+    return out_raster
+
+
+def open_outputs(ref, scene, out_dir, multiband=False, options=None):
+    """
+    Create the output rasters that do not exist yet
+    :param ref: <gdal.Dataset> Reference for the output size and georeferencing
+    :param scene: <str>
+    :param out_dir: <str>
+    :param multiband: <bool> Write one 3-band raster instead of one raster per TC band
+    :param options: <list> GeoTIFF creation options
+    :return: <tuple> (list of datasets, dict of TC band name to gdal.Band)
+    """
+    if multiband:
+        out_file = get_outfile(src=scene, tc_band=MULTIBAND, out_dir=out_dir)
+
+        if os.path.exists(out_file):
+            return [], {}
+
+        out_raster = create_raster(ref=ref, out_file=out_file, nbands=len(TC_BANDS), options=options)
+
+        out_bands = {}
+
+        for ind, key in enumerate(TC_BANDS):
+            out_bands[key] = out_raster.GetRasterBand(ind + 1)
+            out_bands[key].SetDescription(key)
+
+        return [out_raster], out_bands
+
+    out_rasters, out_bands = [], {}
+
+    for key in TC_BANDS:
+        out_file = get_outfile(src=scene, tc_band=key, out_dir=out_dir)
+
+        if not os.path.exists(out_file):
+            out_rasters.append(create_raster(ref=ref, out_file=out_file, options=options))
+            out_bands[key] = out_rasters[-1].GetRasterBand(1)
+
+    return out_rasters, out_bands
 
 
 def calc(coeffs, bands, sensor):
@@ -63,10 +169,10 @@ def calc(coeffs, bands, sensor):
     :param sensor: <str>
     :return: <numpy.ndarray>
     """
-    mask = np.zeros_like(bands["QA"], dtype=np.bool)
+    mask = np.zeros_like(bands["QA"], dtype=bool)
     mask[bands["QA"] != 1] = True
 
-    out_array = np.zeros_like(bands["QA"], dtype=np.float)
+    out_array = np.zeros_like(bands["QA"], dtype=float)
 
     if sensor == "L8":
         out_array[mask] = coeffs["1"] * bands["B2"][mask] + coeffs["2"] * bands["B3"][mask] + \
@@ -80,34 +186,200 @@ def calc(coeffs, bands, sensor):
                           coeffs["3"] * bands["B3"][mask] + coeffs["4"] * bands["B4"][mask] + \
                           coeffs["5"] * bands["B5"][mask] + coeffs["6"] * bands["B7"][mask]
 
-        return out_array.astype(dtype=np.int)
+        return out_array.astype(dtype=int)
 
 
-def get_data(scene, sensor, ext=".tif"):
+def tc_transform(refl, qa, matrix, out=None, work=None):
     """
-    Return dictionary of numpy arrays for each band
-    :param scene: <str>
-    :param sensor: <str>
-    :param ext: <str>
-    :return: <dict>
+    Calculate brightness, greenness, and wetness in a single pass by applying the (3, 6) coefficient
+    matrix to the stacked reflectance bands.  Results are rounded to the nearest integer and clipped to
+    the Int16 range, and fill pixels are set to 0.
+    :param refl: <numpy.ndarray> (6, ...) float32 reflectance, band order as in get_band_list
+    :param qa: <numpy.ndarray> PIXELQA with the same trailing shape as refl
+    :param matrix: <numpy.ndarray> (3, 6) float32 coefficients from get_coeff_matrix
+    :param out: <numpy.ndarray> Optional preallocated (3, ...) Int16 output
+    :param work: <numpy.ndarray> Optional preallocated (3, ...) float32 scratch array
+    :return: <numpy.ndarray> (3, ...) Int16
     """
-    band_data = {}
+    shape = (matrix.shape[0],) + qa.shape
+
+    if out is None:
+        out = np.empty(shape, dtype=np.int16)
+
+    if work is None:
+        work = np.empty(shape, dtype=np.float32)
+
+    np.matmul(matrix, refl.reshape(refl.shape[0], -1), out=work.reshape(shape[0], -1))
+
+    np.rint(work, out=work)
+
+    # Clamp to the Int16 range as GDAL does when writing, rather than letting the cast wrap around
+    np.clip(work, -32768, 32767, out=work)
+
+    out.fill(0)
+
+    np.copyto(out, work, casting="unsafe", where=pixelqa.get_valid_mask(qa))
+
+    return out
+
+
+def tc_transform_fixed(refl, qa, matrix, out=None, work=None):
+    """
+    Fixed-point version of tc_transform that works on the native Int16 reflectance, accumulating in int32
+    without converting any band to floating point.  Results are rounded half up and are within 1 DN of
+    tc_transform.
+    :param refl: <numpy.ndarray> (6, ...) Int16 reflectance, or a sequence of 6 Int16 arrays such as the
+                 memory mapped views from read_window
+    :param qa: <numpy.ndarray> PIXELQA with the same shape as each reflectance band
+    :param matrix: <numpy.ndarray> (3, 6) int32 coefficients from get_fixed_matrix
+    :param out: <numpy.ndarray> Optional preallocated (3, ...) Int16 output
+    :param work: <numpy.ndarray> Optional preallocated (4, ...) int32 scratch array
+    :return: <numpy.ndarray> (3, ...) Int16
+    """
+    shape = (matrix.shape[0],) + qa.shape
+
+    if out is None:
+        out = np.empty(shape, dtype=np.int16)
+
+    if work is None:
+        work = np.empty((shape[0] + 1,) + qa.shape, dtype=np.int32)
+
+    acc, product = work[:shape[0]], work[shape[0]]
+
+    for k in range(shape[0]):
+        np.multiply(refl[0], matrix[k, 0], out=acc[k], dtype=np.int32)
+
+        for j in range(1, matrix.shape[1]):
+            np.multiply(refl[j], matrix[k, j], out=product, dtype=np.int32)
+            np.add(acc[k], product, out=acc[k])
+
+    np.add(acc, 1 << (FIXED_SHIFT - 1), out=acc)
+
+    np.right_shift(acc, FIXED_SHIFT, out=acc)
 
+    np.clip(acc, -32768, 32767, out=acc)
+
+    out.fill(0)
+
+    np.copyto(out, acc, casting="unsafe", where=pixelqa.get_valid_mask(qa))
+
+    return out
+
+
+def get_band_list(sensor):
+    """
+    Return the names of the bands used for the sensor, reflectance bands first and PIXELQA last
+    :param sensor: <str>
+    :return: <list>
+    """
     if sensor == "L8":
-        band_list = ["TAB2", "TAB3", "TAB4", "TAB5", "TAB6", "TAB7", "PIXELQA"]
+        return ["TAB2", "TAB3", "TAB4", "TAB5", "TAB6", "TAB7", "PIXELQA"]
     else:
-        band_list = ["TAB1", "TAB2", "TAB3", "TAB4", "TAB5", "TAB7", "PIXELQA"]
+        return ["TAB1", "TAB2", "TAB3", "TAB4", "TAB5", "TAB7", "PIXELQA"]
+
+
+def open_bands(scene, sensor):
+    """
+    Open each band once, directly from the scene's archive, and return a dictionary of datasets keyed
+    by the last two characters of the band name, e.g. "B2" or "QA"
+    :param scene: <str>
+    :param sensor: <str>
+    :return: <dict>
+    """
+    sources = {}
 
-    for band in band_list:
-        infile = f"{scene}{os.sep}{os.path.basename(scene)[:-7]}_{band}{ext}"
+    for band in get_band_list(sensor):
+        infile = ard_tar.get_band_path(scene, band)
 
         src = gdal.Open(infile, gdal.GA_ReadOnly)
 
-        src_data = src.GetRasterBand(1).ReadAsArray()
+        if src is None:
+            raise IOError(f"Could not open {infile}")
 
-        band_data[band[-2:]] = src_data.astype(np.float32)
+        sources[band[-2:]] = src
 
-    return band_data
+    return sources
+
+
+def open_stack(scene, sensor):
+    """
+    Open a stack made by stack_ard_source.py, returning the dataset and its bands as memory mapped arrays
+    keyed the same way as open_bands
+    :param scene: <str>
+    :param sensor: <str>
+    :return: <tuple> (gdal.Dataset, dict)
+    """
+    ref = gdal.Open(scene, gdal.GA_ReadOnly)
+
+    if ref is None:
+        raise IOError(f"Could not open {scene}")
+
+    return ref, memmap_stack.open_stack(ref, [band[-2:] for band in get_band_list(sensor)])
+
+
+def read_window(sources, sensor, yoff, ysize, refl, qa):
+    """
+    Read a strip of rows from each band directly into the preallocated buffers.  If the sources are
+    arrays from open_stack the PIXELQA strip is returned as a view of the array instead of a copy.
+    :param sources: <dict> Datasets from open_bands or arrays from open_stack
+    :param sensor: <str>
+    :param yoff: <int>
+    :param ysize: <int>
+    :param refl: <numpy.ndarray> (6, n) float32 or Int16 for the fixed-point kernel, n >= ysize * columns
+    :param qa: <numpy.ndarray> (n,) uint16
+    :return: <tuple> Views of refl (or of the arrays from open_stack) and qa covering only the strip
+    """
+    if isinstance(sources["QA"], np.ndarray):
+        cols = sources["QA"].shape[1]
+
+        n = ysize * cols
+
+        qa_win = sources["QA"][yoff:yoff + ysize].reshape(n)
+
+        bands = [sources[band[-2:]][yoff:yoff + ysize] for band in get_band_list(sensor)[:-1]]
+
+        # Kernels that take the stored data type use the views without copying them
+        if all(band.dtype == refl.dtype for band in bands):
+            return [band.reshape(n) for band in bands], qa_win
+
+        for ind, band in enumerate(bands):
+            np.copyto(refl[ind, :n].reshape(ysize, cols), band)
+
+        return refl[:, :n], qa_win
+
+    cols = sources["QA"].RasterXSize
+
+    n = ysize * cols
+
+    for ind, band in enumerate(get_band_list(sensor)[:-1]):
+        sources[band[-2:]].GetRasterBand(1).ReadAsArray(0, yoff, cols, ysize,
+                                                        buf_obj=refl[ind, :n].reshape(ysize, cols))
+
+    sources["QA"].GetRasterBand(1).ReadAsArray(0, yoff, cols, ysize, buf_obj=qa[:n].reshape(ysize, cols))
+
+    return refl[:, :n], qa[:n]
+
+
+def get_windows(band, window_rows=100):
+    """
+    Generate (row offset, row count) strips covering the band.  The strip height is a multiple of the
+    band's native block height so that each block is only decoded once.
+    :param band: <gdal.Band>
+    :param window_rows: <int> The approximate number of rows to read at a time, None reads all rows at once
+    :return: <generator>
+    """
+    rows = band.YSize
+
+    if window_rows is None:
+        yield 0, rows
+        return
+
+    _, block_rows = band.GetBlockSize()
+
+    step = max(block_rows, window_rows // block_rows * block_rows)
+
+    for yoff in range(0, rows, step):
+        yield yoff, min(step, rows - yoff)
 
 
 def get_coeffs(sensor):
@@ -123,6 +395,34 @@ def get_coeffs(sensor):
     return {"brightness": B, "greenness": G, "wetness": W}
 
 
+def get_coeff_matrix(sensor):
+    """
+    Return the TC coefficients as a (3, 6) matrix with rows ordered as TC_BANDS
+    :param sensor: <str>
+    :return: <numpy.ndarray>
+    """
+    return np.array([[tc_bgw_coeffs.coeffs[key][sensor][str(i)] for i in range(1, 7)] for key in TC_BANDS],
+                    dtype=np.float32)
+
+
+def get_fixed_matrix(sensor):
+    """
+    Return the TC coefficients as a (3, 6) int32 matrix scaled by 2 ** FIXED_SHIFT for tc_transform_fixed
+    :param sensor: <str>
+    :return: <numpy.ndarray>
+    """
+    return np.rint(get_coeff_matrix(sensor).astype(np.float64) * (1 << FIXED_SHIFT)).astype(np.int32)
+
+
+# Kernel name to (transform, coefficient matrix function, reflectance data type, scratch array rows and data type)
+KERNELS = {"float": (tc_transform, get_coeff_matrix, np.float32, 3, np.float32),
+           "fixed": (tc_transform_fixed, get_fixed_matrix, np.int16, 4, np.int32)}
+
+# The numba kernel falls back to the float kernel when numba is not installed
+KERNELS["numba"] = (tc_numba.tc_transform_numba, get_coeff_matrix, np.int16, 0, np.float32) \
+    if tc_numba.AVAILABLE else KERNELS["float"]
+
+
 def get_sensor(scene):
     """
 
@@ -134,51 +434,181 @@ def get_sensor(scene):
     return basename[0] + basename[3]
 
 
-def calculate_tc(scene, out_dir):
+def calculate_tc(scene, out_dir, window_rows=None, multiband=False, options=None, hist=False, cube_dir=None,
+                 cube_only=False, kernel="float"):
     """
-
+    Calculate the TC bands for a scene.  If window_rows is given the scene is processed one strip of rows
+    at a time, writing each strip to the outputs before the next one is read, so peak memory is bounded
+    by the strip size rather than by the scene size.
     :param scene: <str>
     :param out_dir: <str>
+    :param window_rows: <int> The approximate number of rows per strip, None reads whole bands
+    :param multiband: <bool> Write one 3-band raster instead of one raster per TC band
+    :param options: <list> GeoTIFF creation options
+    :param hist: <bool> Save histograms of the clear and non-fill values of each TC band for rescale.py
+    :param cube_dir: <str> Also append the TC bands to the tile's time series cube under this directory
+    :param cube_only: <bool> Only append to the cube, without writing GeoTIFFs
+    :param kernel: <str> A key of KERNELS, "float", "fixed" (Int16 input with int32 fixed-point arithmetic), or "numba"
     :return:
     """
     sensor = get_sensor(scene=scene)
 
-    coeffs = get_coeffs(sensor=sensor)
+    transform, get_matrix, refl_dtype, work_rows, work_dtype = KERNELS[kernel]
+
+    matrix = get_matrix(sensor=sensor)
 
     print(scene, sensor)
-    bands = get_data(scene=scene, sensor=sensor)
+    if memmap_stack.is_stack(scene):
+        ref, sources = open_stack(scene=scene, sensor=sensor)
+
+    else:
+        sources = open_bands(scene=scene, sensor=sensor)
+
+        ref = sources["QA"]
+
+    if cube_only:
+        out_rasters, out_bands = [], {}
+
+    else:
+        out_rasters, out_bands = open_outputs(ref=ref, scene=scene, out_dir=out_dir, multiband=multiband,
+                                              options=options)
+
+    cube, cube_writer = None, None
+
+    if cube_dir is not None:
+        cube = tc_cube.TCCube(cube_dir, *ard_tar.get_hv(scene))
+
+    try:
+        if cube is not None:
+            cube_writer = cube.open_writer(scene, sensor)
+
+        if len(out_bands) == 0 and cube_writer is None:
+            return None
+
+        cols = ref.RasterXSize
+
+        windows = list(get_windows(ref.GetRasterBand(1), window_rows=window_rows))
+
+        size = windows[0][1] * cols
+
+        # Buffers are allocated once per scene and reused for every strip
+        refl = np.empty((6, size), dtype=refl_dtype)
+        qa = np.empty(size, dtype=np.uint16)
+        work = np.empty((work_rows, size), dtype=work_dtype)
+        out = np.empty((3, size), dtype=np.int16)
+
+        hists = {f"{key}_{mask}": np.zeros(histogram.NBINS, dtype=np.int64)
+                 for key in TC_BANDS for mask in ("clear", "fill")} if hist else None
+
+        for yoff, ysize in windows:
+            n = ysize * cols
+
+            refl_win, qa_win = read_window(sources, sensor, yoff, ysize, refl=refl, qa=qa)
 
-    for key in coeffs.keys():
-        temp_data = calc(coeffs=coeffs[key], bands=bands, sensor=sensor)
-        get_raster(data=temp_data, src=scene, out_dir=out_dir, tc_band=key)
+            tc_data = transform(refl=refl_win, qa=qa_win, matrix=matrix, out=out[:, :n], work=work[:, :n])
+
+            for ind, key in enumerate(TC_BANDS):
+                if key in out_bands:
+                    out_bands[key].WriteArray(tc_data[ind].reshape(ysize, cols), 0, yoff)
+
+            if cube_writer is not None:
+                cube_writer.write(tc_data.reshape(3, ysize, cols))
+
+            if hists is not None:
+                mask_clear, mask_fill = pixelqa.get_masks(qa_win, sensor)
+
+                for ind, key in enumerate(TC_BANDS):
+                    histogram.get_histogram(tc_data[ind], mask_clear, hist=hists[f"{key}_clear"])
+                    histogram.get_histogram(tc_data[ind], mask_fill, hist=hists[f"{key}_fill"])
+
+        if cube_writer is not None:
+            cube_writer.close()
+
+        if hists is not None:
+            histogram.write_sidecar(get_outfile(src=scene, tc_band="hist", out_dir=out_dir, ext=".npz"), hists)
+
+    finally:
+        # The cube is closed even when the scene was already in it or failed part way
+        if cube is not None:
+            cube.close()
+
+    out_bands, out_rasters, sources, ref = None, None, None, None
 
     return None
 
 
-def main_work(output_dir, ard_dir=None, txt_file=None):
+def main_work(output_dir, ard_dir=None, txt_file=None, stacks=False, windowed=False, window_rows=100, workers=1,
+              cache_mb=None, multiband=False, compress="NONE", predictor=None, tiled=False, bigtiff=False, hist=False,
+              cube_dir=None, cube_only=False, kernel="float", manifest_file=None):
     """
 
     :param ard_dir: <str>
     :param output_dir: <str>
+    :param txt_file: <str>
+    :param stacks: <bool> Read the *_TAstack.tif files made by stack_ard_source.py under ard_dir instead of archives
+    :param windowed: <bool> Process each scene in strips of rows instead of reading whole bands
+    :param window_rows: <int> The approximate number of rows per strip when windowed is True
+    :param workers: <int> The number of scenes to process in parallel
+    :param cache_mb: <int> The GDAL cache size in megabytes for each worker
+    :param multiband: <bool> Write one 3-band raster per scene instead of one raster per TC band
+    :param compress: <str> GeoTIFF compression, NONE, DEFLATE, ZSTD, or LZW
+    :param predictor: <int> GeoTIFF predictor used with compression
+    :param tiled: <bool> Write tiled instead of striped GeoTIFFs
+    :param bigtiff: <bool> Write BigTIFF files
+    :param hist: <bool> Save a histogram sidecar for each scene that rescale.py uses for the percentiles
+    :param cube_dir: <str> Also append each scene to the time series cube of its tile under this directory
+    :param cube_only: <bool> Only append to the cube, without writing GeoTIFFs
+    :param kernel: <str> "float", "fixed" to calculate from the Int16 bands in int32 fixed-point, or "numba"
+    :param manifest_file: <str> Optional run manifest, scenes it records as done are skipped
     :return:
     """
     if txt_file is None and ard_dir is not None:
-        file_list = get_scenes.get_files(directory=ard_dir)
+        if stacks:
+            file_list = memmap_stack.find_stacks(directory=ard_dir)
 
-        # get_scenes.get_files returns files within tarfile, only want the path to the tarfile for now
-        for ind, f in enumerate(file_list):
-            file_list[ind] = os.path.split(f)[0]
+        else:
+            file_list = ard_tar.find_archives(directory=ard_dir)
 
     elif ard_dir is None and txt_file is not None:
         with open(txt_file, "r") as input_file:
-            file_list = [line[:-1] for line in input_file if ".tar" in line]
+            file_list = [line[:-1] for line in input_file if ".tar" in line or "stack.tif" in line]
 
     else:
         print("Either an input directory (-i) or a file list (-f) must be specified")
         sys.exit(1)
 
-    for f in file_list:
-        calculate_tc(f, output_dir)
+    if kernel == "numba" and not tc_numba.AVAILABLE:
+        print("numba is not installed, using the float kernel")
+
+    if cube_only and cube_dir is None:
+        print("--cube-only requires a cube directory (--cube)")
+        sys.exit(1)
+
+    # A scene appended to the cube leaves no output of its own for the manifest to check
+    if cube_only and manifest_file is not None:
+        print("--cube-only cannot be used with a run manifest (--manifest)")
+        sys.exit(1)
+
+    options = get_creation_options(compress=compress, predictor=predictor, tiled=tiled or multiband, bigtiff=bigtiff)
+
+    args = (output_dir, window_rows if windowed else None, multiband, options, hist, cube_dir, cube_only,
+            kernel)
+
+    params = {"multiband": multiband, "options": options, "hist": hist, "cube_dir": cube_dir, "cube_only": cube_only,
+              "kernel": kernel}
+
+    tasks = ((scene, [scene if memmap_stack.is_stack(scene) else ard_tar.get_tar_path(scene)],
+              get_outputs(scene, output_dir, multiband=multiband, hist=hist, cube_only=cube_only), scene)
+             for scene in file_list)
+
+    run_manifest = manifest.Manifest(manifest_file) if manifest_file is not None else None
+
+    start = time.time()
+
+    results = list(manifest.run_stage(run_manifest, "tasseled_cap", tasks, params, calculate_tc, args=args,
+                                      workers=workers, cache_mb=cache_mb))
+
+    scene_pool.summarize(results, elapsed=time.time() - start)
 
     return None
 
@@ -191,11 +621,47 @@ if __name__ == "__main__":
     parser = ArgumentParser(description=description)
 
     parser.add_argument("-i", "--input", dest="ard_dir", type=str, required=False, default=None,
-                        help="The full path to the directory containing stacked ARD TA products")
+                        help="The full path to the directory containing ARD TA tarfiles")
     parser.add_argument("-o", "--output", dest="output_dir", type=str, required=True,
                         help="The full path to the output directory")
     parser.add_argument("-f", "--file_list", dest="txt_file", type=str, required=False, default=None,
                         help="The full path to the .txt file containing the input file list")
+    parser.add_argument("-s", "--stacks", dest="stacks", action="store_true",
+                        help="Read the *_TAstack.tif files made by stack_ard_source.py under the input directory, "
+                             "memory mapping uncompressed stacks, instead of the TA tarfiles")
+    parser.add_argument("-w", "--windowed", dest="windowed", action="store_true",
+                        help="Process each scene in strips of rows to limit memory use")
+    parser.add_argument("-r", "--rows", dest="window_rows", type=int, required=False, default=100,
+                        help="The approximate number of rows per strip in windowed mode, default is 100")
+    parser.add_argument("-n", "--workers", dest="workers", type=int, required=False, default=1,
+                        help="The number of scenes to process in parallel, default is 1")
+    parser.add_argument("-c", "--cache", dest="cache_mb", type=int, required=False, default=None,
+                        help="The GDAL cache size in MB for each worker")
+    parser.add_argument("-m", "--multiband", dest="multiband", action="store_true",
+                        help="Write brightness, greenness, and wetness as one tiled 3-band GeoTIFF per scene")
+    parser.add_argument("--compress", dest="compress", type=str, required=False, default="NONE",
+                        choices=["NONE", "DEFLATE", "ZSTD", "LZW"], help="The GeoTIFF compression, default is NONE")
+    parser.add_argument("--predictor", dest="predictor", type=int, required=False, default=None, choices=[1, 2],
+                        help="The GeoTIFF predictor to use with compression")
+    parser.add_argument("--tiled", dest="tiled", action="store_true",
+                        help="Write tiled GeoTIFFs, always used with --multiband")
+    parser.add_argument("--bigtiff", dest="bigtiff", action="store_true",
+                        help="Write BigTIFF files")
+    parser.add_argument("--hist", dest="hist", action="store_true",
+                        help="Save a histogram sidecar (*_hist.npz) that rescale.py uses for the percentiles")
+    parser.add_argument("--kernel", dest="kernel", type=str, required=False, default="float",
+                        choices=list(KERNELS),
+                        help="float32 arithmetic, fixed to read the bands as Int16 and use int32 fixed-point "
+                             "arithmetic (within 1 DN of float), or numba for a fused parallel loop over the Int16 "
+                             "bands if numba is installed, default is float")
+    parser.add_argument("--manifest", dest="manifest_file", type=str, required=False, default=None,
+                        help="The full path to a run manifest, created if it does not exist, scenes it records as "
+                             "done are skipped")
+    parser.add_argument("--cube", dest="cube_dir", type=str, required=False, default=None,
+                        help="Also append each scene to a time series cube of its tile under this directory")
+    parser.add_argument("--cube-only", dest="cube_only", action="store_true",
+                        help="Only append to the cube given by --cube, without writing GeoTIFFs, cannot be used "
+                             "with --manifest")
 
     args = parser.parse_args()
 
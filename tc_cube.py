@@ -0,0 +1,264 @@
+"""
+Store the brightness, greenness, and wetness of every scene of an ARD tile in a (time, band, y, x) cube
+chunked by chip.  Each of the tile's 2500 chips is one raw Int16 file of (time, 3, 100, 100) records, so
+the whole history of a pixel or chip is read from a single file.  An SQLite index in the cube directory
+records the date, sensor, and scene of each time slot.
+
+Scenes are appended in any order and from any number of processes.  Each scene is given its own time
+slot in the index before it is written, so writers never touch the same part of a chip file, and the
+slot is only marked complete once every chip has been written.
+"""
+
+import os
+import sqlite3
+
+import numpy as np
+
+import ard_tar
+from geo_utils import CHIP_PIXELS, CHIPS_PER_SIDE, get_tile
+
+NBANDS = 3
+
+# Bytes of one time slot in a chip file
+RECORD_SIZE = NBANDS * CHIP_PIXELS * CHIP_PIXELS * np.dtype(np.int16).itemsize
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    slot INTEGER PRIMARY KEY,
+    scene TEXT UNIQUE,
+    date TEXT,
+    sensor TEXT,
+    complete INTEGER
+);
+"""
+
+
+def get_cube_dir(root, h, v):
+    """
+    :param root: <str>
+    :param h: <int>
+    :param v: <int>
+    :return: <str>
+    """
+    return f"{root}{os.sep}H{h:03d}V{v:03d}"
+
+
+class CubeWriter:
+    def __init__(self, cube, slot):
+        """
+        Collect strips of rows of a scene until a full row of chips is available, then write each chip of
+        that row to its time slot
+
+        :param cube: <TCCube>
+        :param slot: <int>
+        """
+        self.cube = cube
+
+        self.slot = slot
+
+        self.buffer = np.zeros((NBANDS, CHIP_PIXELS, CHIPS_PER_SIDE * CHIP_PIXELS), dtype=np.int16)
+
+        self.row = 0
+
+    def write(self, tc_data):
+        """
+        Add the next strip of rows
+        :param tc_data: <numpy.ndarray> (3, rows, 5000) Int16, strips must be given in order from the top
+        :return:
+        """
+        start = 0
+
+        while start < tc_data.shape[1]:
+            fill = self.row % CHIP_PIXELS
+
+            n = min(CHIP_PIXELS - fill, tc_data.shape[1] - start)
+
+            self.buffer[:, fill:fill + n] = tc_data[:, start:start + n]
+
+            start += n
+
+            self.row += n
+
+            if self.row % CHIP_PIXELS == 0:
+                self.flush(self.row // CHIP_PIXELS - 1)
+
+        return None
+
+    def flush(self, chip_row):
+        """
+        Write each chip of a full row of chips
+        :param chip_row: <int>
+        :return:
+        """
+        for chip_col in range(CHIPS_PER_SIDE):
+            chip = self.buffer[:, :, chip_col * CHIP_PIXELS:(chip_col + 1) * CHIP_PIXELS]
+
+            self.cube.write_chip(chip_row * CHIPS_PER_SIDE + chip_col + 1, self.slot, chip)
+
+        return None
+
+    def close(self):
+        """
+        Mark the scene complete once every row has been written
+        :return:
+        """
+        if self.row != CHIPS_PER_SIDE * CHIP_PIXELS:
+            raise IOError(f"Only {self.row} rows were written to time slot {self.slot} of {self.cube.path}")
+
+        self.cube.finish(self.slot)
+
+        return None
+
+
+class TCCube:
+    def __init__(self, root, h, v):
+        """
+
+        :param root: <str> The cube of each tile is kept in a H{hhh}V{vvv} directory under root
+        :param h: <int>
+        :param v: <int>
+        """
+        self.H = h
+
+        self.V = v
+
+        self.path = get_cube_dir(root, h, v)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+
+        self.conn = sqlite3.connect(f"{self.path}{os.sep}index.db", timeout=60)
+
+        self.conn.executescript(SCHEMA)
+
+    def get_chip_file(self, chip_id):
+        """
+        :param chip_id: <int> 1 - 2500
+        :return: <str>
+        """
+        return f"{self.path}{os.sep}chip_{chip_id:04d}.bin"
+
+    def open_writer(self, scene, sensor):
+        """
+        Reserve a time slot for the scene.  A scene that was only partly written before is given its
+        previous slot again.
+        :param scene: <str>
+        :param sensor: <str>
+        :return: <CubeWriter> None if the scene is already in the cube
+        """
+        with self.conn:
+            row = self.conn.execute("SELECT slot, complete FROM records WHERE scene = ?", (scene,)).fetchone()
+
+            if row is None:
+                self.conn.execute("INSERT INTO records SELECT COALESCE(MAX(slot) + 1, 0), ?, ?, ?, 0 FROM records",
+                                  (scene, ard_tar.get_date(scene), sensor))
+
+                row = self.conn.execute("SELECT slot, complete FROM records WHERE scene = ?", (scene,)).fetchone()
+
+        if row[1]:
+            return None
+
+        return CubeWriter(self, row[0])
+
+    def write_chip(self, chip_id, slot, chip):
+        """
+        Write one chip of a scene to its time slot.  The file is never truncated, so other processes can
+        write their own slots at the same time.
+        :param chip_id: <int>
+        :param slot: <int>
+        :param chip: <numpy.ndarray> (3, 100, 100) Int16
+        :return:
+        """
+        fd = os.open(self.get_chip_file(chip_id), os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0))
+
+        with os.fdopen(fd, "r+b") as chip_file:
+            chip_file.seek(slot * RECORD_SIZE)
+
+            chip_file.write(np.ascontiguousarray(chip, dtype=np.int16).tobytes())
+
+        return None
+
+    def finish(self, slot):
+        """
+        :param slot: <int>
+        :return:
+        """
+        with self.conn:
+            self.conn.execute("UPDATE records SET complete = 1 WHERE slot = ?", (slot,))
+
+        return None
+
+    def get_index(self):
+        """
+        Return the complete time slots ordered by date
+        :return: <list> (slot, date, sensor, scene)
+        """
+        return self.conn.execute("SELECT slot, date, sensor, scene FROM records WHERE complete = 1 "
+                                 "ORDER BY date, slot").fetchall()
+
+    def get_chip_array(self, chip_id):
+        """
+        Memory map a chip file without reading it
+        :param chip_id: <int>
+        :return: <numpy.memmap> (slots, 3, 100, 100) Int16 in slot order
+        """
+        chip_file = self.get_chip_file(chip_id)
+
+        slots = os.path.getsize(chip_file) // RECORD_SIZE
+
+        return np.memmap(chip_file, dtype=np.int16, mode="r", shape=(slots, NBANDS, CHIP_PIXELS, CHIP_PIXELS))
+
+    def read_chip(self, chip_id):
+        """
+        Read the time series of a chip
+        :param chip_id: <int> 1 - 2500
+        :return: <tuple> (index from get_index, (time, 3, 100, 100) Int16 array ordered by date)
+        """
+        index = self.get_index()
+
+        slots = [record[0] for record in index]
+
+        if len(slots) == 0:
+            return index, np.zeros((0, NBANDS, CHIP_PIXELS, CHIP_PIXELS), dtype=np.int16)
+
+        return index, np.asarray(self.get_chip_array(chip_id)[slots])
+
+    def read_pixel(self, row, column):
+        """
+        Read the time series of a pixel
+        :param row: <int> Row within the tile, 0 - 4999
+        :param column: <int> Column within the tile, 0 - 4999
+        :return: <tuple> (index from get_index, (time, 3) Int16 array ordered by date)
+        """
+        chip_id = get_tile(self.H, self.V).rowcol_to_chip(row, column)
+
+        if chip_id == 0:
+            raise IndexError(f"Pixel {row}, {column} is outside of tile H{self.H}V{self.V}")
+
+        index = self.get_index()
+
+        slots = [record[0] for record in index]
+
+        if len(slots) == 0:
+            return index, np.zeros((0, NBANDS), dtype=np.int16)
+
+        chip = self.get_chip_array(chip_id)
+
+        return index, np.array(chip[slots, :, row % CHIP_PIXELS, column % CHIP_PIXELS])
+
+    def read_point(self, x, y):
+        """
+        Read the time series of the pixel containing a geo-coordinate
+        :param x:
+        :param y:
+        :return: <tuple> See read_pixel
+        """
+        tile = get_tile(self.H, self.V)
+
+        # Rounded down, so a point just above or left of the tile is outside of it rather than in row or column 0
+        row, column = tile.geo_to_rowcol_array(tile.PIXEL_AFFINE, x, y)
+
+        return self.read_pixel(int(row), int(column))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,68 @@
+"""
+Fused TC kernel compiled with numba.  Each pixel is checked for fill, its three TC values are calculated,
+and the rounded Int16 results are written in a single parallel loop, without any temporary arrays.
+numba is optional; AVAILABLE is False when it is not installed and tasseled_cap.py then uses the NumPy
+kernel instead.
+"""
+
+import numpy as np
+
+try:
+    import numba
+
+except ImportError:
+    numba = None
+
+AVAILABLE = numba is not None
+
+
+if AVAILABLE:
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def fused_transform(b1, b2, b3, b4, b5, b6, qa, matrix, out):
+        """
+        :param b1 - b6: <numpy.ndarray> (n,) reflectance, band order as in tasseled_cap.get_band_list
+        :param qa: <numpy.ndarray> (n,) PIXELQA
+        :param matrix: <numpy.ndarray> (3, 6) float32 coefficients
+        :param out: <numpy.ndarray> (3, n) Int16
+        :return:
+        """
+        for i in numba.prange(qa.shape[0]):
+            if qa[i] & 1:
+                for k in range(3):
+                    out[k, i] = 0
+
+                continue
+
+            for k in range(3):
+                # float32 products summed in band order, the same arithmetic as tasseled_cap.calc
+                value = matrix[k, 0] * np.float32(b1[i]) + matrix[k, 1] * np.float32(b2[i]) + \
+                    matrix[k, 2] * np.float32(b3[i]) + matrix[k, 3] * np.float32(b4[i]) + \
+                    matrix[k, 4] * np.float32(b5[i]) + matrix[k, 5] * np.float32(b6[i])
+
+                value = np.rint(value)
+
+                out[k, i] = min(max(value, -32768.0), 32767.0)
+
+
+def tc_transform_numba(refl, qa, matrix, out=None, work=None):
+    """
+    Numba version of tasseled_cap.tc_transform.  The arithmetic is the same as tasseled_cap.calc, so results
+    are identical to rounding its output, and values beyond the Int16 range are clipped.
+    :param refl: <numpy.ndarray> (6, ...) reflectance of any data type, or a sequence of 6 arrays such as
+                 the memory mapped views from tasseled_cap.read_window
+    :param qa: <numpy.ndarray> PIXELQA with the same shape as each reflectance band
+    :param matrix: <numpy.ndarray> (3, 6) float32 coefficients from tasseled_cap.get_coeff_matrix
+    :param out: <numpy.ndarray> Optional preallocated (3, ...) Int16 output
+    :param work: Not used, accepted so the kernels are interchangeable
+    :return: <numpy.ndarray> (3, ...) Int16
+    """
+    shape = (matrix.shape[0],) + qa.shape
+
+    if out is None:
+        out = np.empty(shape, dtype=np.int16)
+
+    bands = [refl[j].reshape(-1) for j in range(matrix.shape[1])]
+
+    fused_transform(*bands, qa.reshape(-1), matrix.astype(np.float32), out.reshape(shape[0], -1))
+
+    return out
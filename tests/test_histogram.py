@@ -0,0 +1,51 @@
+"""
+Compare the histogram percentiles of histogram.py against np.percentile
+"""
+
+import numpy as np
+import pytest
+
+import histogram
+
+PERCENTILES = [0, 0.5, 2, 25, 50, 75, 98, 99.5, 100]
+
+
+def make_inputs(seed=0):
+    """
+    Random Int16 arrays: the whole Int16 range, a narrow range with many duplicates, and a single value
+    :param seed: <int>
+    :return: <list>
+    """
+    rng = np.random.RandomState(seed)
+
+    return [rng.randint(-32768, 32768, size=10000).astype(np.int16),
+            rng.randint(-5, 6, size=997).astype(np.int16),
+            np.array([1234], dtype=np.int16),
+            np.full(50, -32768, dtype=np.int16)]
+
+
+@pytest.mark.parametrize("index", range(4))
+def test_percentiles(index):
+    data = make_inputs()[index]
+
+    result = histogram.get_percentiles(histogram.get_histogram(data), PERCENTILES)
+
+    assert np.allclose(result, np.percentile(data.astype(np.float64), PERCENTILES))
+
+
+def test_percentiles_mask_and_sum():
+    data = make_inputs()[0]
+
+    mask = data > 0
+
+    # Histograms of separate windows add up to the histogram of the whole array
+    hist = histogram.get_histogram(data[:5000], mask=mask[:5000])
+
+    histogram.get_histogram(data[5000:], mask=mask[5000:], hist=hist)
+
+    assert np.allclose(histogram.get_percentiles(hist, PERCENTILES), np.percentile(data[mask], PERCENTILES))
+
+
+def test_empty_histogram():
+    with pytest.raises(ValueError):
+        histogram.get_percentiles(np.zeros(histogram.NBINS, dtype=np.int64), [50])
@@ -0,0 +1,67 @@
+"""
+Check the PIXELQA lookup table of pixelqa.py against known PIXELQA values
+"""
+
+import numpy as np
+import pytest
+
+import pixelqa
+
+LEGACY = ["L4", "L5", "L7"]
+
+# (sensors, PIXELQA value, clear, other flag expected to be set or None)
+CASES = [
+    # The clear land and water values the scripts used before the lookup table
+    (LEGACY, 66, True, None),
+    (LEGACY, 68, True, pixelqa.WATER),
+    (["L8"], 322, True, None),
+    (["L8"], 324, True, pixelqa.WATER),
+    # Fill
+    (LEGACY + ["L8"], 1, False, pixelqa.FILL),
+    # Cloud with high confidence
+    (LEGACY, 224, False, pixelqa.CLOUD),
+    (["L8"], 480, False, pixelqa.CLOUD),
+    # Cloud shadow and snow with low cloud confidence
+    (LEGACY, 72, False, pixelqa.SHADOW),
+    (["L8"], 328, False, pixelqa.SHADOW),
+    (LEGACY, 80, False, pixelqa.SNOW),
+    (["L8"], 336, False, pixelqa.SNOW),
+    # Clear bit set, but medium cloud confidence
+    (LEGACY, 130, False, None),
+    (["L8"], 386, False, None),
+    # Clear bit set, but medium or high cirrus confidence, or terrain occlusion
+    (["L8"], 578, False, None),
+    (["L8"], 834, False, None),
+    (["L8"], 1346, False, None),
+    # The cirrus and terrain bits are only used for L8
+    (LEGACY, 66 + 768, True, None),
+    (LEGACY, 66 + 1024, True, None),
+]
+
+PARAMS = [(sensor, value, clear, flag) for sensors, value, clear, flag in CASES for sensor in sensors]
+
+
+@pytest.mark.parametrize("sensor, value, clear, flag", PARAMS)
+def test_decode(sensor, value, clear, flag):
+    qa = np.array([[value]], dtype=np.uint16)
+
+    flags = int(pixelqa.decode(qa, sensor)[0, 0])
+
+    assert bool(flags & pixelqa.CLEAR) == clear
+
+    if flag is not None:
+        assert flags & flag
+
+    mask_clear, mask_fill = pixelqa.get_masks(qa, sensor)
+
+    assert bool(mask_clear[0, 0]) == clear
+
+    assert bool(mask_fill[0, 0]) == (value & 1 == 0)
+
+
+def test_count_flags():
+    qa = np.array([66, 66, 68, 1, 224, 72], dtype=np.uint16)
+
+    counts = pixelqa.count_flags(qa, "L5")
+
+    assert counts == {"fill": 1, "clear": 3, "water": 1, "shadow": 1, "snow": 0, "cloud": 1, "total": 6}
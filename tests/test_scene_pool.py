@@ -0,0 +1,79 @@
+"""
+Check that scene_pool.run_scenes keeps going when scenes fail, hang, or kill their worker process
+"""
+
+import os
+import time
+
+import pytest
+
+pytest.importorskip("osgeo")
+
+import scene_pool
+
+
+def work(scene, marker_dir=None):
+    if scene == "die":
+        os._exit(1)
+
+    if scene == "slow":
+        time.sleep(2)
+
+    if scene == "hang":
+        time.sleep(60)
+
+    if scene == "bad":
+        raise ValueError("always fails")
+
+    if scene == "flaky":
+        marker = os.path.join(marker_dir, scene)
+
+        if not os.path.exists(marker):
+            open(marker, "w").close()
+            raise IOError("fails the first time")
+
+    time.sleep(0.1)
+
+    return scene
+
+
+def get_errors(results):
+    return {scene: error for scene, _, _, error in results}
+
+
+def test_dead_worker():
+    start = time.time()
+
+    errors = get_errors(scene_pool.run_scenes(work, ["a", "die", "b", "c", "d"], workers=2))
+
+    assert time.time() - start < 20
+
+    assert errors["die"].startswith("BrokenProcessPool")
+
+    # Only the scene that killed its worker fails
+    assert all(errors[scene] is None for scene in "abcd")
+
+
+def test_slow_scene_does_not_block():
+    results = list(scene_pool.run_scenes(work, ["slow"] + list("abcdefgh"), workers=2))
+
+    assert results[-1][0] == "slow"
+
+
+def test_retries(tmp_path):
+    errors = get_errors(scene_pool.run_scenes(work, ["flaky", "bad", "a"], args=(str(tmp_path),), workers=2,
+                                              retries=2, backoff=0.1))
+
+    assert errors["flaky"] is None and errors["a"] is None
+
+    assert errors["bad"] == "ValueError: always fails (after 3 attempts)"
+
+
+def test_timeout():
+    start = time.time()
+
+    errors = get_errors(scene_pool.run_scenes(work, ["hang", "a", "b"], workers=2, timeout=2))
+
+    assert time.time() - start < 20
+
+    assert errors["hang"].startswith("TimeoutError") and errors["a"] is None and errors["b"] is None
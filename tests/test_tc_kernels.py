@@ -0,0 +1,103 @@
+"""
+Compare the TC kernels of tasseled_cap.py against an exact float64 reference
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+
+import benchmarks
+import tasseled_cap
+import tc_numba
+
+SENSORS = ["L4", "L5", "L7", "L8"]
+
+
+def make_inputs(size=200, seed=0):
+    """
+    Random reflectance over the valid range -2000 to 16000, with a saturated block of every band at 16000
+    and a block of fill pixels
+    :param size: <int>
+    :param seed: <int>
+    :return: <tuple> (6, size, size) Int16 reflectance and (size, size) PIXELQA
+    """
+    rng = np.random.RandomState(seed)
+
+    refl = rng.randint(-2000, 16001, size=(6, size, size)).astype(np.int16)
+
+    refl[:, :20, :20] = 16000
+
+    qa = np.full((size, size), 322, dtype=np.uint16)
+
+    qa[-20:, -20:] = 1
+
+    return refl, qa
+
+
+def get_reference(refl, qa, sensor):
+    """
+    :param refl: <numpy.ndarray> (6, ...)
+    :param qa: <numpy.ndarray>
+    :param sensor: <str>
+    :return: <numpy.ndarray> (3, ...) float64, rounded, clipped to Int16 and 0 for fill
+    """
+    matrix = tasseled_cap.get_coeff_matrix(sensor).astype(np.float64)
+
+    values = np.tensordot(matrix, refl.astype(np.float64), axes=1)
+
+    values = np.clip(np.rint(values), -32768, 32767)
+
+    values[:, qa == 1] = 0
+
+    return values
+
+
+@pytest.mark.parametrize("sensor", SENSORS)
+def test_float_kernel(sensor):
+    refl, qa = make_inputs()
+
+    result = tasseled_cap.tc_transform(refl.astype(np.float32), qa, tasseled_cap.get_coeff_matrix(sensor))
+
+    reference = get_reference(refl, qa, sensor)
+
+    assert np.abs(result - reference).max() <= 1
+
+    # Saturated brightness is clamped rather than wrapped around
+    assert np.all(result[0, :20, :20] == 32767)
+
+    assert np.all(result[:, -20:, -20:] == 0)
+
+
+@pytest.mark.parametrize("sensor", SENSORS)
+def test_fixed_kernel(sensor):
+    refl, qa = make_inputs()
+
+    result = tasseled_cap.tc_transform_fixed(refl, qa, tasseled_cap.get_fixed_matrix(sensor))
+
+    assert np.abs(result - get_reference(refl, qa, sensor)).max() <= 1
+
+    assert np.all(result[0, :20, :20] == 32767)
+
+    assert np.all(result[:, -20:, -20:] == 0)
+
+
+@pytest.mark.skipif(not tc_numba.AVAILABLE, reason="numba is not installed")
+@pytest.mark.parametrize("sensor", SENSORS)
+def test_numba_kernel(sensor):
+    refl, qa = make_inputs()
+
+    result = tc_numba.tc_transform_numba(refl, qa, tasseled_cap.get_coeff_matrix(sensor))
+
+    assert np.abs(result - get_reference(refl, qa, sensor)).max() <= 1
+
+    # The same float32 arithmetic as calc, so identical to its rounded output
+    bands = {band[-2:]: refl[j].astype(np.float32) for j, band in enumerate(tasseled_cap.get_band_list(sensor)[:-1])}
+
+    bands["QA"] = qa.astype(np.float32)
+
+    calc_values = np.clip(np.rint(benchmarks.get_calc_values(bands, sensor)), -32768, 32767)
+
+    assert np.array_equal(result, calc_values)
+
+    assert np.all(result[:, -20:, -20:] == 0)